@@ -61,16 +61,12 @@ def main(FLAGS):
             'parallax_over_error',
         )
 
-    # Read in data
-    data = io.read_rslice(keys, gal, lsr, rslice,
-        basedir=config.DR3_BASEDIR, ijobs=range(Njob))
-
-    # Select only data with POE > 10 and with radial velocity
-    select = (
-        (~np.isnan(data['radial_velocity']))
-        & (data['parallax_over_error'] > 10)
-    )
-    data = {k: data[k][select] for k in data}
+    # Read in only data with POE > 10 and with radial velocity
+    catalog = io.Catalog.from_rslice(
+        gal, lsr, rslice, basedir=config.DR3_BASEDIR, ijobs=range(Njob))
+    data = catalog.select(*keys).where(
+        lambda d: (~np.isnan(d['radial_velocity'])) & (d['parallax_over_error'] > 10),
+        'radial_velocity', 'parallax_over_error').read()
 
     # Calculate the perpendicular velocity and parallel velocity
     if use_true:
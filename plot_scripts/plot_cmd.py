@@ -72,13 +72,11 @@ def main(FLAGS):
             'parallax_over_error', 'parallax_true'
         )
 
-    # Read in data
-    data = io.read_rslice(keys, gal, lsr, rslice,
-        basedir=envs.DR3_BASEDIR, ijobs=range(Njob))
-
-    # Select only data with POE > 10
-    select = (data['parallax_over_error'] > 10)
-    data = {k: data[k][select] for k in data}
+    # Read in only data with POE > 10
+    catalog = io.Catalog.from_rslice(
+        gal, lsr, rslice, basedir=envs.DR3_BASEDIR, ijobs=range(Njob))
+    data = catalog.select(*keys).where(
+        lambda d: d['parallax_over_error'] > 10, 'parallax_over_error').read()
 
 
     # Calculate the extincted, absolute magnitude
@@ -53,9 +53,13 @@ def main(FLAGS):
             'l', 'b', 'parallax', 'pml', 'pmb', 'radial_velocity'
         )
 
-    # read in data
-    data = io.read_rslice(keys, gal, lsr, rslice,
-        basedir=config.DR3_BASEDIR, ijobs=range(Njob))
+    # read in data, only stars with radial velocity for error-convolved values
+    catalog = io.Catalog.from_rslice(
+        gal, lsr, rslice, basedir=config.DR3_BASEDIR, ijobs=range(Njob)).select(*keys)
+    if not use_true:
+        catalog = catalog.where(
+            lambda d: ~np.isnan(d['radial_velocity']), 'radial_velocity')
+    data = catalog.read()
 
     if use_true:
         px = data['px_true']
@@ -66,10 +70,6 @@ def main(FLAGS):
         vz = data['vz_true']
     else:
         # convert l, b, parallax, proper motions and radial velocity to Cartesian
-        # first, select only stars with radial velocity
-        select = (~np.isnan(data['radial_velocity']))
-        data = {k: data[k][select] for k in data}
-
         logger.info('Convert l, b, parallax, proper motions, and RV to Cartesian')
         galactic = coord.Galactic(
             l=data['l'] * u.deg, b=data['b'] * u.deg,
@@ -0,0 +1,123 @@
+
+import re
+
+from . import metrics
+from .logger import logger
+
+# Units of memory sizes, in powers of 1024
+_MEMORY_UNITS = {'': 0, 'K': 1, 'M': 2, 'G': 3, 'T': 4}
+
+# Smallest batch size picked from a memory budget
+_MIN_BATCH_SIZE = 1000
+
+# Number of input batches in memory at once with read-ahead, see io.process_chunks
+_INPUT_BATCHES_IN_FLIGHT = 2
+
+def parse_memory(string):
+    """ Parse a memory size, e.g. 64G, 500M or 1.5GB, into bytes """
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([KMGT]?)i?B?\s*', string, re.IGNORECASE)
+    if match is None:
+        raise ValueError(f"Invalid memory size: {string}")
+    num, unit = match.groups()
+    return int(float(num) * 1024**_MEMORY_UNITS[unit.upper()])
+
+class BatchSizer:
+    """ Pick the batch size of a stage from a memory budget
+
+    Without a budget, the batches have the fixed size `batch_size`. With a
+    budget, the batch size is the largest one for which the batches in memory
+    at once, at `bytes_per_row`, fit into the budget minus the memory already
+    used by the process and the `reserved_bytes` that the stage allocates
+    outside of the batches, e.g. a selection mask of all rows. If `adapt` is set, the peak resident set size of each
+    batch is measured after computing it and, if it exceeds the estimate, the
+    estimate is raised and the following batches are made smaller.
+    """
+    def __init__(self, batch_size, memory_budget=None, bytes_per_row=None, adapt=True,
+                 reserved_bytes=0):
+        self.batch_size = batch_size
+        self.memory_budget = memory_budget
+        self.bytes_per_row = bytes_per_row
+        self.reserved_bytes = reserved_bytes
+        self.adapt = False
+        if memory_budget is None:
+            return
+
+        self.base_rss = metrics.read_rss()
+        if memory_budget <= self.base_rss + reserved_bytes:
+            raise ValueError(
+                f"Memory budget of {memory_budget} bytes is below the "
+                f"{self.base_rss} bytes already used and {reserved_bytes} bytes reserved")
+        self.batch_size = self._fit()
+        # measuring each batch requires resetting the peak RSS
+        self.adapt = adapt and metrics.reset_peak_rss()
+        logger.info(
+            f"Batch size {self.batch_size} at {self.bytes_per_row:.0f} bytes per row")
+
+    def _fit(self):
+        """ Return the largest batch size that fits into the budget """
+        available = self.memory_budget - self.base_rss - self.reserved_bytes
+        return max(_MIN_BATCH_SIZE, int(available // self.bytes_per_row))
+
+    def num_batches(self, start, stop):
+        """ Return the number of batches of a row range at the current batch size """
+        return (stop - start + self.batch_size - 1) // self.batch_size
+
+    def iter_batches(self, start, stop):
+        """ Iterate over the (i_batch, i_start, i_stop) of the batches of a row
+        range. The size of each batch is the current batch size when it is
+        requested, so batches requested after update may be smaller """
+        i_batch = 0
+        i_start = start
+        while i_start < stop:
+            i_stop = min(i_start + self.batch_size, stop)
+            yield i_batch, i_start, i_stop
+            i_batch += 1
+            i_start = i_stop
+
+    def update(self, num_rows):
+        """ Measure the peak RSS of a batch of `num_rows` rows that was just
+        computed and shrink the following batches if it exceeds the estimate.
+        Must be called on the thread that computes the batches. The peak RSS is
+        then reset, so that each call only measures its own batch, whether or
+        not the batches are recorded with metrics.record_batch. With read-ahead,
+        the next batch is already being read, so the new size applies from the
+        one after. """
+        if not self.adapt:
+            return
+        peak_rss = metrics.read_peak_rss()
+        metrics.reset_batch_peak_rss()
+
+        # the last batch is smaller, so fixed costs weigh more per row
+        if num_rows < self.batch_size:
+            return
+        bytes_per_row = (peak_rss - self.base_rss) / num_rows
+        if bytes_per_row > self.bytes_per_row:
+            self.bytes_per_row = bytes_per_row
+            self.batch_size = self._fit()
+            logger.warning(
+                f"Measured {bytes_per_row:.0f} bytes per row, more than estimated. "
+                f"Reduce batch size to {self.batch_size}")
+
+def get_batch_sizer(FLAGS, columns, temp_columns=0, copies=1, adapt=True, reserved_bytes=0):
+    """ Return the batch sizer of a stage from the command line arguments
+
+    Args:
+    - FLAGS: command line arguments with `batch_size` and optionally `memory_budget`
+    - columns: [list] datasets, or arrays, read for each batch
+    - temp_columns: [int] float64 columns created while computing a batch,
+    including the output columns
+    - copies: [int] number of batches computed at once, e.g. by worker processes
+    - adapt: [bool] measure the peak RSS of each batch, see BatchSizer
+    - reserved_bytes: [int] memory allocated by the stage outside of the batches
+
+    The temporary columns of the stages are rough estimates, rounded up from
+    the peak RSS measured on synthetic rslices.
+    """
+    memory_budget = getattr(FLAGS, 'memory_budget', None)
+    if memory_budget is None:
+        return BatchSizer(FLAGS.batch_size)
+    input_bytes = sum(col.dtype.itemsize for col in columns)
+    bytes_per_row = copies * (_INPUT_BATCHES_IN_FLIGHT * input_bytes + 8 * temp_columns)
+    return BatchSizer(
+        FLAGS.batch_size, memory_budget=memory_budget, bytes_per_row=bytes_per_row,
+        adapt=adapt, reserved_bytes=reserved_bytes)
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+import argparse
+import functools
+import json
+import logging
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from ananke import config, coordinates, errors, extinction, selection, kernels
+from ananke.errors import photometric
+from ananke.logger import logger
+from ananke.benchmarks import synthetic
+from ananke.bin import calc_props, gmag_cut, rotate_coords, selection_function, split_hdf5
+
+_DEFAULT_SIZES = (100000, 1000000)
+
+# Galaxy, LSR and rslice of the synthetic rslice
+_GAL = 'm12i'
+_LSR = 0
+_RSLICE = 0
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-N', '--sizes', required=False, type=float, nargs='+',
+                        default=_DEFAULT_SIZES, help='Number of stars of each benchmark')
+    parser.add_argument('--repeat', required=False, type=int, default=3,
+                        help='Number of repeats of each function benchmark')
+    parser.add_argument('--batch-size', required=False, type=int, default=1000000,
+                        help='Batch size of the stage benchmarks')
+    parser.add_argument('--skip-stages', required=False, action='store_true',
+                        help='Only benchmark the functions')
+    parser.add_argument('--workdir', required=False, type=str, default=None,
+                        help='Directory in which to create the temporary directory of the '
+                             'synthetic files, which is deleted afterward. Default to the '
+                             'system temporary directory')
+    parser.add_argument('--output', required=False, type=str, default=None,
+                        help='Write the results to a JSON file')
+    parser.add_argument('--baseline', required=False, type=str, default=None,
+                        help='JSON file of previous results to compare with')
+    return parser.parse_args()
+
+def trace(func, *args, **kwargs):
+    """ Run a function once. Return the run time in seconds and the peak memory
+    in bytes allocated during the run, as traced by tracemalloc """
+    tracemalloc.start()
+    try:
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        run_time = time.perf_counter() - t0
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return run_time, peak
+
+def measure(func, *args, repeat=1, **kwargs):
+    """ Return the best run time in seconds over `repeat` untraced runs and the
+    peak memory in bytes of a separate traced run """
+    run_time = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func(*args, **kwargs)
+        run_time = min(run_time, time.perf_counter() - t0)
+    _, peak = trace(func, *args, **kwargs)
+    return run_time, peak
+
+def make_function_data(num, seed=0):
+    """ Return a synthetic batch with all the input columns of the hot functions """
+    rng = np.random.default_rng(seed)
+    data = synthetic.make_batch(num, rng)
+    calc_props.calc_batch(data)
+    return data
+
+def get_function_benchmarks(data):
+    """ Return the hot functions to benchmark as (name, function, args) """
+    benchmarks = [
+        ('calc_coords', coordinates.calc_coords, (data, )),
+        ('calc_extinction', extinction.calc_extinction, (data, )),
+        ('mag_uncertainties', photometric.mag_uncertainties,
+         ('g', data['phot_g_mean_mag_true'])),
+        ('calc_errors', errors.calc_errors, (data, )),
+        ('calc_general_select', selection.calc_general_select, (data, )),
+        ('calc_rvs_select', selection.calc_rvs_select, (data, )),
+    ]
+    if kernels.numba is not None:
+        # the kernels are compiled on the first call, so use --repeat 2 or more
+        benchmarks += [
+            ('calc_extinction[numba]',
+             functools.partial(extinction.calc_extinction, engine='numba'), (data, )),
+            ('calc_errors[numba]',
+             functools.partial(errors.calc_errors, engine='numba'), (data, )),
+            ('calc_rvs_select[numba]',
+             functools.partial(selection.calc_rvs_select, engine='numba'), (data, )),
+        ]
+    return benchmarks
+
+def make_stage_flags(batch_size):
+    """ Return the command line arguments of the stages """
+    return argparse.Namespace(
+        gal=_GAL, lsr=_LSR, rslice=_RSLICE, ijob=0, Njob=1,
+        ext_extrapolate=False, err_extrapolate=False, ext_var='bminr', seed=0,
+        which='both', batch_size=batch_size, workers=1, split_mode='virtual',
+        source='hdf5', recompute=None)
+
+def run_stage_benchmarks(num, FLAGS, workdir):
+    """ Time each stage of the pipeline on a synthetic rslice of `num` stars.
+    Stages modify their input in place, so each is only run once, with tracing. """
+    config.HDF5_BASEDIR = os.path.join(workdir, 'gaia_mocks_hdf5')
+    config.DR3_PRESF_BASEDIR = os.path.join(workdir, 'ananke_dr3/preSF')
+    config.DR3_BASEDIR = os.path.join(workdir, 'ananke_dr3')
+
+    in_path = os.path.join(
+        config.HDF5_BASEDIR, f"{_GAL}/lsr-{_LSR}",
+        f"lsr-{_LSR}-rslice-{_RSLICE}.{_GAL}-res7100-md-sliced-gcat-dr3.hdf5")
+    os.makedirs(os.path.dirname(in_path), exist_ok=True)
+    synthetic.write_rslice(in_path, num, batch_size=FLAGS.batch_size)
+
+    stage_flags = make_stage_flags(FLAGS.batch_size)
+    results = []
+    for stage in (split_hdf5, gmag_cut, rotate_coords, calc_props, selection_function):
+        name = stage.__name__.split('.')[-1]
+        run_time, peak = trace(stage.main, stage_flags)
+        results.append(dict(kind='stage', name=name, size=num, time=run_time, peak=peak))
+    return results
+
+def format_result(result, baseline=None):
+    """ Format a benchmark result as a row of the result table """
+    row = '{:<6} {:<22} {:>10d} {:>10.4f} {:>14.3e} {:>12.1f}'.format(
+        result['kind'], result['name'], result['size'], result['time'],
+        result['size'] / result['time'], result['peak'] / 1024**2)
+    if baseline is not None:
+        row += ' {:>9.2f}x'.format(baseline['time'] / result['time'])
+    return row
+
+def main():
+    """ Run all benchmarks """
+    FLAGS = parse_cmd()
+
+    # silence the progress logs of the stages
+    logger.setLevel(logging.WARNING)
+
+    # the temporary directories of the stage benchmarks are created in it
+    if FLAGS.workdir is not None:
+        os.makedirs(FLAGS.workdir, exist_ok=True)
+
+    baseline = {}
+    if FLAGS.baseline is not None:
+        with open(FLAGS.baseline, 'r') as f:
+            baseline = {(r['kind'], r['name'], r['size']): r for r in json.load(f)}
+
+    header = '{:<6} {:<22} {:>10} {:>10} {:>14} {:>12}'.format(
+        'kind', 'name', 'rows', 'time [s]', 'rows/s', 'peak [MB]')
+    if baseline:
+        header += ' {:>10}'.format('speedup')
+    print(header)
+
+    results = []
+    for num in FLAGS.sizes:
+        num = int(num)
+        data = make_function_data(num)
+        for name, func, args in get_function_benchmarks(data):
+            run_time, peak = measure(func, *args, repeat=FLAGS.repeat)
+            result = dict(kind='func', name=name, size=num, time=run_time, peak=peak)
+            results.append(result)
+            print(format_result(result, baseline.get(('func', name, num))), flush=True)
+        del data
+
+        if FLAGS.skip_stages:
+            continue
+        with tempfile.TemporaryDirectory(dir=FLAGS.workdir) as workdir:
+            for result in run_stage_benchmarks(num, FLAGS, workdir):
+                results.append(result)
+                print(format_result(
+                    result, baseline.get(('stage', result['name'], num))), flush=True)
+
+    if FLAGS.output is not None:
+        with open(FLAGS.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+if __name__ == "__main__":
+    main()
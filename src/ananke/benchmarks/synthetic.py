@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+
+import argparse
+import h5py
+import os
+import time
+
+import numpy as np
+
+from ananke import coordinates, config, io
+from ananke.logger import logger
+from ananke.bin import gmag_cut
+
+# Fraction of giants and halo stars of the synthetic rslice
+_GIANT_FRACTION = 0.1
+_HALO_FRACTION = 0.05
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gal', required=False, type=str, default='m12i',
+                         help='Galaxy name of run')
+    parser.add_argument('--lsr', required=False, type=int, default=0,
+                        help='LSR number of run')
+    parser.add_argument('--rslice', required=False, type=int, default=0,
+                        help='Radial slice of run')
+    parser.add_argument('-N', '--num', required=True, type=float,
+                        help='Number of stars')
+    parser.add_argument('--out', required=False, type=str, default=None,
+                        help='Output path. Default to the converted rslice in HDF5_BASEDIR')
+    parser.add_argument('--seed', required=False, type=int, default=0,
+                        help='Seed of the random number generator')
+    parser.add_argument('--batch-size', required=False, type=int, default=1000000,
+                        help='Batch size')
+    return parser.parse_args()
+
+def make_batch(num, rng, dist_min=0.01, dist_max=5.):
+    """ Generate a batch of synthetic stars with the columns of a converted rslice
+
+    The distributions are only roughly realistic: distances are uniform in
+    volume within [dist_min, dist_max] kpc, the Hess diagram is a main sequence
+    plus a red clump, the kinematics are a thin disk plus a halo, and the dust
+    extinction grows with the distance to the star within the dust layer.
+    """
+    data = {}
+
+    # positions in heliocentric Galactic coordinates in kpc
+    dist = (dist_min**3 + (dist_max**3 - dist_min**3) * rng.random(num))**(1 / 3)
+    lon = rng.uniform(0, 2 * np.pi, num)
+    lat = np.arcsin(rng.uniform(-1, 1, num))
+    data['px_true'] = dist * np.cos(lat) * np.cos(lon)
+    data['py_true'] = dist * np.cos(lat) * np.sin(lon)
+    data['pz_true'] = dist * np.sin(lat)
+    data['dmod_true'] = 5 * np.log10(dist * 100)
+    data['l_true'] = np.rad2deg(lon)
+    data['b_true'] = np.rad2deg(lat)
+    ra, dec = coordinates.cartesian_to_lonlat(*coordinates.rotate(
+        coordinates._GAL_TO_ICRS, data['px_true'], data['py_true'], data['pz_true']))
+    data['ra_true'] = ra
+    data['dec_true'] = dec
+
+    # velocities in km/s
+    is_halo = rng.random(num) < _HALO_FRACTION
+    data['vx_true'] = np.where(is_halo, rng.normal(0, 150, num), rng.normal(0, 35, num))
+    data['vy_true'] = np.where(
+        is_halo, rng.normal(-220, 100, num), rng.normal(-15, 25, num))
+    data['vz_true'] = np.where(is_halo, rng.normal(0, 100, num), rng.normal(0, 20, num))
+
+    # absolute magnitudes and effective temperature
+    is_giant = rng.random(num) < _GIANT_FRACTION
+    g_abs = np.where(
+        is_giant, rng.normal(0.5, 1., num), np.clip(rng.normal(7, 3, num), -3, 16))
+    bp_rp = np.where(
+        is_giant, rng.normal(1.2, 0.2, num),
+        np.clip(0.1 + 0.22 * g_abs + rng.normal(0, 0.1, num), -0.3, 4.5))
+    g_rp = 0.05 + 0.45 * bp_rp
+    data['phot_g_mean_mag_abs'] = g_abs
+    data['phot_rp_mean_mag_abs'] = g_abs - g_rp
+    data['phot_bp_mean_mag_abs'] = g_abs - g_rp + bp_rp
+    teff = 5040 / (0.4929 + 0.5092 * bp_rp - 0.0353 * bp_rp**2)
+    data['logteff'] = np.log10(np.clip(teff, 2500, 40000))
+    data['logg'] = np.where(is_giant, rng.normal(2.5, 0.3, num), rng.normal(4.5, 0.2, num))
+    data['lum'] = -0.4 * (g_abs - 4.67)
+
+    # extinction
+    height = np.abs(data['pz_true'])
+    a_0 = 1.5 * dist * np.exp(-height / 0.15) * rng.lognormal(0, 0.5, num)
+    data['A0'] = a_0
+    data['ebv'] = a_0 / 3.1
+    data['lognh'] = np.log10(2.2e21 * a_0 + 1e19)
+
+    # stellar parameters
+    data['parentid'] = rng.integers(0, 10**8, num)
+    data['partid'] = rng.integers(0, 2, num)
+    data['mini'] = rng.lognormal(-0.7, 0.6, num)
+    data['mact'] = data['mini'] * rng.uniform(0.8, 1, num)
+    data['mtip'] = data['mini'] + rng.uniform(0, 0.5, num)
+    data['age'] = rng.uniform(6, 10.1, num)
+    data['feh'] = np.where(is_halo, rng.normal(-1.5, 0.5, num), rng.normal(-0.1, 0.25, num))
+    data['alpha'] = np.clip(-0.3 * data['feh'], 0, 0.4) + rng.normal(0, 0.05, num)
+    for key in ('carbon', 'helium', 'nitrogen', 'sulphur', 'oxygen', 'silicon',
+                'calcium', 'magnesium', 'neon'):
+        data[key] = data['feh'] + rng.normal(0, 0.1, num)
+
+    return data
+
+def write_rslice(path, num, seed=0, batch_size=1000000, **kwargs):
+    """ Write a synthetic rslice of `num` stars in batches to an hdf5 file.
+    The keyword arguments are passed to make_batch """
+    rng = np.random.default_rng(seed)
+    keys = list(config.ALL_MOCK_KEYS.values()) + list(config.ALL_EXT_KEYS.values())
+    with h5py.File(path, 'w') as f:
+        for i_start in range(0, num, batch_size):
+            i_stop = min(i_start + batch_size, num)
+            data = make_batch(i_stop - i_start, rng, **kwargs)
+            for key in keys:
+                if key not in f:
+                    io.preallocate_dataset(f, key, num, data[key].dtype)
+                f[key][i_start: i_stop] = data[key]
+        gmag_cut.write_gmag_counts(f, batch_size)
+
+def main(FLAGS):
+    """ Write a synthetic rslice """
+    out_path = FLAGS.out
+    if out_path is None:
+        out_path = os.path.join(
+            config.HDF5_BASEDIR, f"{FLAGS.gal}/lsr-{FLAGS.lsr}",
+            f"lsr-{FLAGS.lsr}-rslice-{FLAGS.rslice}.{FLAGS.gal}-res7100-md-sliced-gcat-dr3.hdf5")
+    os.makedirs(os.path.dirname(os.path.abspath(out_path)), exist_ok=True)
+
+    logger.info(f"Write {int(FLAGS.num)} synthetic stars to {out_path}")
+    write_rslice(out_path, int(FLAGS.num), seed=FLAGS.seed, batch_size=FLAGS.batch_size)
+
+if __name__ == "__main__":
+    FLAGS = parse_cmd()
+
+    # run main and keep track of time
+    t0 = time.time()
+    main(FLAGS)
+    t1 = time.time()
+    logger.info(f"Total run time: {t1 - t0}")
+    logger.info("Done!")
@@ -4,10 +4,19 @@ import argparse
 import h5py
 import os
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 
-from ananke import coordinates, errors, extinction, io, config
+from ananke import coordinates, errors, extinction, io, config, metrics, batching, kernels
+from ananke.rng import ChunkRNG
 from ananke.logger import logger
 
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ('ext_var', 'ext_extrapolate', 'err_extrapolate', 'seed')
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gal', required=True, type=str,
@@ -25,10 +34,271 @@ def parse_cmd():
     parser.add_argument('--ext-var', required=False, default='bminr',
                         choices=('bminr', 'logteff'),
                         help='Variable to calculate extinction coefficient')
+    parser.add_argument('--seed', required=False, type=int, default=0,
+                        help='Seed of the random number generator of the errors')
     parser.add_argument('--batch-size', required=False, type=int, default=1000000,
                         help='Batch size')
+    parser.add_argument('--workers', required=False, type=int, default=1,
+                        help='Number of worker processes')
+    parser.add_argument('--memory-budget', required=False, type=batching.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 64G, to pick the batch size from '
+                             'instead of --batch-size')
+    parser.add_argument('--recompute', required=False, default=None,
+                        choices=('coords', 'extinction', 'errors'),
+                        help='Only recompute these columns, and the errors that depend on them, '
+                             'of a finished run in place')
+    parser.add_argument('--engine', required=False, default=kernels._DEFAULT_ENGINE,
+                        choices=kernels._ENGINES,
+                        help='Compute extinction and RV errors with NumPy or compiled numba kernels')
     return parser.parse_args()
 
+# File attributes that keep track of the progress of calc_props
+_ROWS_DONE_ATTR = 'calc_props_rows_done'
+_INPUT_KEYS_ATTR = 'calc_props_input_keys'
+_RECOMPUTE_ATTR = 'calc_props_recompute'
+
+# Input columns of calc_batch, read ahead of each batch
+INPUT_KEYS = (
+    'ra_true', 'dec_true', 'px_true', 'py_true', 'pz_true',
+    'vx_true', 'vy_true', 'vz_true', 'dmod_true', 'A0', 'logteff',
+    'phot_g_mean_mag_abs', 'phot_bp_mean_mag_abs', 'phot_rp_mean_mag_abs',
+)
+
+# Input columns needed to recompute each part of calc_batch and the errors, read
+# ahead of each batch. Any other column is read by the ColumnCache on first use
+RECOMPUTE_INPUT_KEYS = {
+    'coords': (
+        'dmod_true', 'px_true', 'py_true', 'pz_true', 'vx_true', 'vy_true', 'vz_true',
+        'ra_true', 'dec_true', 'logteff', 'phot_g_mean_mag_true',
+        'phot_bp_mean_mag_true', 'phot_rp_mean_mag_true'),
+    'extinction': (
+        'dmod_true', 'A0', 'logteff', 'phot_g_mean_mag_abs', 'phot_bp_mean_mag_abs',
+        'phot_rp_mean_mag_abs', 'ra_true', 'dec_true', 'parallax_true', 'pmra_true',
+        'pmdec_true', 'radial_velocity_true'),
+    'errors': (
+        'ra_true', 'dec_true', 'parallax_true', 'pmra_true', 'pmdec_true',
+        'radial_velocity_true', 'logteff', 'phot_g_mean_mag_true',
+        'phot_bp_mean_mag_true', 'phot_rp_mean_mag_true'),
+}
+
+# Float64 columns created by calc_batch per row, including its output, and
+# by recompute_batch, for --memory-budget
+TEMP_COLUMNS = 80
+RECOMPUTE_TEMP_COLUMNS = 60
+
+# Header entries that may change when recomputing each part of calc_batch
+RECOMPUTE_HEADER_KEYS = {
+    'coords': ('err-extrapolate', 'seed', 'calc_props-version'),
+    'extinction': ('ext-extrapolate', 'ext-var', 'err-extrapolate', 'seed',
+                   'calc_props-version'),
+    'errors': ('err-extrapolate', 'seed', 'calc_props-version'),
+}
+
+def calc_errors_and_colors(data, indices=(None, None), extrapolate=False, rng=None,
+                           engine=kernels._DEFAULT_ENGINE):
+    """ Calculate errors and the colors of the convolved magnitudes """
+    err_data = errors.calc_errors(
+        data, indices=indices, extrapolate=extrapolate, rng=rng, engine=engine)
+    err_data['bp_rp'] = err_data['phot_bp_mean_mag'] - err_data['phot_rp_mean_mag']
+    err_data['bp_g'] = err_data['phot_bp_mean_mag'] - err_data['phot_g_mean_mag']
+    err_data['g_rp'] = err_data['phot_g_mean_mag'] - err_data['phot_rp_mean_mag']
+    return err_data
+
+def calc_batch(data, ext_var='bminr', ext_extrapolate=False, err_extrapolate=False,
+               rng=None, engine=kernels._DEFAULT_ENGINE):
+    """ Calculate coordinates, extincted magnitudes, and errors of an in-memory batch
+
+    The new columns are added to `data`, which must be a mutable mapping of arrays,
+    e.g. an `io.ColumnCache` of the batch.
+    `rng` is the random number generator of the batch (see `ananke.rng`).
+    `engine` computes the extinction and RV errors (see `ananke.kernels`).
+    """
+    # coordinate conversion
+    data.update(coordinates.calc_coords(data))
+
+    # calculate extinction
+    data.update(extinction.calc_extinction(
+        data, ext_var=ext_var, extrapolate=ext_extrapolate, engine=engine))
+
+    # calculate error
+    data.update(calc_errors_and_colors(
+        data, extrapolate=err_extrapolate, rng=rng, engine=engine))
+
+    return data
+
+def recompute_batch(data, recompute, ext_var='bminr', ext_extrapolate=False,
+                    err_extrapolate=False, rng=None, engine=kernels._DEFAULT_ENGINE):
+    """ Recompute one part of calc_batch of an in-memory batch, then the errors
+    and colors that depend on it. Returns only the recomputed columns """
+    new_data = {}
+    if recompute == 'coords':
+        new_data.update(coordinates.calc_coords(data))
+    elif recompute == 'extinction':
+        new_data.update(extinction.calc_extinction(
+            data, ext_var=ext_var, extrapolate=ext_extrapolate, engine=engine))
+    elif recompute != 'errors':
+        raise ValueError(f"Unknown part to recompute: {recompute}")
+    data.update(new_data)
+
+    new_data.update(calc_errors_and_colors(
+        data, extrapolate=err_extrapolate, rng=rng, engine=engine))
+    return new_data
+
+def _calc_batch_worker(data, ext_var, ext_extrapolate, err_extrapolate, rng,
+                       engine=kernels._DEFAULT_ENGINE):
+    """ Run calc_batch and return only the new columns """
+    if not isinstance(data, io.ColumnCache):
+        data = io.ColumnCache(data)
+    calc_batch(data, ext_var=ext_var, ext_extrapolate=ext_extrapolate,
+               err_extrapolate=err_extrapolate, rng=rng, engine=engine)
+    return data.computed()
+
+def get_header(FLAGS):
+    """ Return the file attributes of the arguments of calc_props """
+    return {
+        "ext-extrapolate": FLAGS.ext_extrapolate,
+        "err-extrapolate": FLAGS.err_extrapolate,
+        "ext-var": FLAGS.ext_var,
+        "seed": FLAGS.seed,
+        "calc_props-version": VERSION,
+    }
+
+def init_checkpoint(f, header):
+    """ Initialize or resume the progress of calc_props.
+
+    The number of committed rows is kept in the file attributes. Columns of a
+    batch that was not committed, e.g. because the job hit its walltime, are
+    truncated back to the committed rows. If the header differs from the one
+    of the previous run, all new columns are deleted to restart from scratch.
+
+    Returns the number of committed rows
+    """
+    if _INPUT_KEYS_ATTR not in f.attrs:
+        f.attrs[_INPUT_KEYS_ATTR] = list(f.keys())
+        rows_done = 0
+    elif any(f.attrs.get(key) != val for key, val in header.items()):
+        logger.warning("Header differs from previous run. Restart from scratch")
+        rows_done = 0
+    else:
+        rows_done = int(f.attrs.get(_ROWS_DONE_ATTR, 0))
+
+    # roll back uncommitted batches
+    input_keys = set(f.attrs[_INPUT_KEYS_ATTR])
+    for key in list(f.keys()):
+        if key in input_keys:
+            continue
+        if rows_done == 0:
+            del f[key]
+        elif len(f[key]) != rows_done:
+            logger.info(f"Truncate {key} to {rows_done} rows")
+            f[key].resize(rows_done, axis=0)
+
+    f.attrs.update(header)
+    f.attrs[_ROWS_DONE_ATTR] = rows_done
+    return rows_done
+
+def commit_batch(f, rows_done):
+    """ Mark all rows up to `rows_done` as committed once their data is on disk """
+    f.flush()
+    f.attrs[_ROWS_DONE_ATTR] = rows_done
+    f.flush()
+
+def run_parallel(f, FLAGS, rng, row_offset=0, rows_done=0):
+    """ Calculate properties with a pool of worker processes
+
+    The main process reads the input columns of each batch and is the only
+    writer, so the new columns are appended to the file in batch order.
+    At most two batches per worker are in flight at any time. The memory of
+    the workers is not measured, so the batch size is not adapted to it.
+    """
+    N = len(f['dmod_true'])
+    engine = getattr(FLAGS, 'engine', kernels._DEFAULT_ENGINE)
+    sizer = batching.get_batch_sizer(
+        FLAGS, [f[key] for key in INPUT_KEYS], TEMP_COLUMNS,
+        copies=2 * FLAGS.workers, adapt=False)
+    # count the batches from the start of the file, also after resuming
+    i_done = sizer.num_batches(0, rows_done)
+    N_batch = i_done + sizer.num_batches(rows_done, N)
+
+    with ProcessPoolExecutor(max_workers=FLAGS.workers) as executor:
+        futures = deque()
+        for i_batch, i_start, i_stop in sizer.iter_batches(rows_done, N):
+            i_batch += i_done
+            logger.info(f'Progress [{i_batch}/{N_batch}]')
+            data = {key: f[key][i_start: i_stop] for key in INPUT_KEYS}
+            futures.append((i_batch, i_start, i_stop, executor.submit(
+                _calc_batch_worker, data, FLAGS.ext_var, FLAGS.ext_extrapolate,
+                FLAGS.err_extrapolate, rng.at(row_offset + i_start), engine)))
+
+            # write finished batches in order
+            if len(futures) >= 2 * FLAGS.workers:
+                i_batch, i_start, i_stop, future = futures.popleft()
+                io.append_dataset_dict(f, future.result(), overwrite=False)
+                commit_batch(f, i_stop)
+                metrics.record_batch(
+                    rows_in=i_stop - i_start, rows_out=i_stop - i_start, i_batch=i_batch)
+        while futures:
+            i_batch, i_start, i_stop, future = futures.popleft()
+            io.append_dataset_dict(f, future.result(), overwrite=False)
+            commit_batch(f, i_stop)
+            metrics.record_batch(
+                rows_in=i_stop - i_start, rows_out=i_stop - i_start, i_batch=i_batch)
+
+def run_recompute(f, FLAGS, header, rng, row_offset=0):
+    """ Overwrite the columns of one part of calc_props, and the errors that
+    depend on them, in place batch by batch. Only the columns needed for the
+    recomputation are read. The selection function must be rerun afterward. """
+    N = len(f['dmod_true'])
+    if int(f.attrs.get(_ROWS_DONE_ATTR, 0)) < N:
+        raise ValueError("calc_props must be complete before recomputing columns")
+
+    # the header of the parts that are not recomputed must not change
+    changed_keys = RECOMPUTE_HEADER_KEYS[FLAGS.recompute]
+    for key, val in header.items():
+        if key not in changed_keys and f.attrs.get(key) != val:
+            raise ValueError(
+                f"{key} differs from previous run ({f.attrs.get(key)} != {val}). "
+                "Rerun calc_props from scratch instead")
+
+    # mark the file as partially recomputed until all batches are done
+    f.attrs[_RECOMPUTE_ATTR] = FLAGS.recompute
+
+    input_keys = RECOMPUTE_INPUT_KEYS[FLAGS.recompute]
+    engine = getattr(FLAGS, 'engine', kernels._DEFAULT_ENGINE)
+    sizer = batching.get_batch_sizer(
+        FLAGS, [f[key] for key in input_keys], RECOMPUTE_TEMP_COLUMNS)
+
+    def read_batch(batch):
+        _, i_start, i_stop = batch
+        return io.ColumnCache(f, i_start, i_stop, keys=input_keys)
+
+    def compute_batch(batch, data):
+        i_batch, i_start, i_stop = batch
+        N_batch = i_batch + sizer.num_batches(i_start, N)
+        logger.info(f'Progress [{i_batch}/{N_batch}]')
+        data = recompute_batch(
+            data, FLAGS.recompute, ext_var=FLAGS.ext_var,
+            ext_extrapolate=FLAGS.ext_extrapolate,
+            err_extrapolate=FLAGS.err_extrapolate, rng=rng.at(row_offset + i_start),
+            engine=engine)
+        sizer.update(i_stop - i_start)
+        metrics.record_batch(
+            rows_in=i_stop - i_start, rows_out=i_stop - i_start, i_batch=i_batch)
+        return data
+
+    def write_batch(batch, data):
+        _, i_start, i_stop = batch
+        for key, val in data.items():
+            f[key][i_start: i_stop] = val
+
+    io.process_chunks(sizer.iter_batches(0, N), read_batch, compute_batch, write_batch)
+    metrics.record_rows(N, N)
+
+    f.flush()
+    f.attrs.update(header)
+    del f.attrs[_RECOMPUTE_ATTR]
+
 def main(FLAGS):
     """ Calculate catalog properties """
     gal = FLAGS.gal
@@ -44,40 +314,74 @@ def main(FLAGS):
     logger.info("Calculate extra coordinates, extincted magnitudes, and errors")
     logger.info(f"In: {in_path}")
 
+    header = get_header(FLAGS)
+    recompute = getattr(FLAGS, 'recompute', None)
+    engine = getattr(FLAGS, 'engine', kernels._DEFAULT_ENGINE)
+    kernels._check_engine(engine)
+
     with h5py.File(in_path, 'a') as f:
-        # Add header
-        f.attrs.update({
-            "ext-extrapolate": FLAGS.ext_extrapolate,
-            "err-extrapolate": FLAGS.err_extrapolate,
-            "ext-var": FLAGS.ext_var,
-        })
+        rng = ChunkRNG(gal, lsr, rslice, seed=FLAGS.seed)
+        row_offset = f.attrs.get('row_offset', 0)
+
+        if recompute is not None:
+            if int(f.attrs.get(_ROWS_DONE_ATTR, 0)) < len(f['dmod_true']):
+                # e.g. the input was produced again by an upstream stage
+                logger.warning(
+                    f"calc_props is not complete. Run it in full instead of "
+                    f"recomputing {recompute}")
+            else:
+                logger.info(f"Recompute {recompute} in place")
+                run_recompute(f, FLAGS, header, rng, row_offset)
+                return
+        if _RECOMPUTE_ATTR in f.attrs:
+            raise ValueError(
+                "Recomputing {0} was interrupted. Rerun with --recompute {0}".format(
+                    f.attrs[_RECOMPUTE_ATTR]))
+
+        # Add header and resume from the last committed batch
+        rows_done = init_checkpoint(f, header)
 
         N = len(f['dmod_true'])
-        N_batch = (N + FLAGS.batch_size - 1) // FLAGS.batch_size
+        if rows_done >= N:
+            logger.info("All batches are already done")
+            return
+        if rows_done > 0:
+            logger.info(f"Resume from row {rows_done} / {N}")
+        metrics.record_rows(N - rows_done, N - rows_done)
 
-        for i_batch in range(N_batch):
+        if FLAGS.workers > 1:
+            logger.info(f"Running with {FLAGS.workers} worker processes")
+            run_parallel(f, FLAGS, rng, row_offset, rows_done)
+            return
+
+        sizer = batching.get_batch_sizer(FLAGS, [f[key] for key in INPUT_KEYS], TEMP_COLUMNS)
+        # count the batches from the start of the file, also after resuming
+        i_done = sizer.num_batches(0, rows_done)
+
+        def read_batch(batch):
+            _, i_start, i_stop = batch
+            return io.ColumnCache(f, i_start, i_stop, keys=INPUT_KEYS)
+
+        def compute_batch(batch, data):
+            i_batch, i_start, i_stop = batch
+            i_batch += i_done
+            N_batch = i_batch + sizer.num_batches(i_start, N)
             logger.info(f'Progress [{i_batch}/{N_batch}]')
-            i_start = i_batch * FLAGS.batch_size
-            i_stop = i_start + FLAGS.batch_size
-            indices = (i_start, i_stop)
-
-            # coordinate conversion
-            data = coordinates.calc_coords(f, indices=indices)
-            io.append_dataset_dict(f, data, overwrite=False)
-
-            # calculate extinction
-            data = extinction.calc_extinction(
-                f, indices=indices, ext_var=FLAGS.ext_var,
-                extrapolate=FLAGS.ext_extrapolate)
-            io.append_dataset_dict(f, data, overwrite=False)
-
-            # calculate error
-            data = errors.calc_errors(
-                f, indices=indices, extrapolate=FLAGS.err_extrapolate)
-            data['bp_rp'] = data['phot_bp_mean_mag'] - data['phot_rp_mean_mag']
-            data['bp_g'] = data['phot_bp_mean_mag'] - data['phot_g_mean_mag']
-            data['g_rp'] = data['phot_g_mean_mag'] - data['phot_rp_mean_mag']
-            io.append_dataset_dict(f, data, overwrite=False)
+            new_data = _calc_batch_worker(
+                data, FLAGS.ext_var, FLAGS.ext_extrapolate, FLAGS.err_extrapolate,
+                rng.at(row_offset + i_start), engine)
+            sizer.update(i_stop - i_start)
+            metrics.record_batch(
+                rows_in=i_stop - i_start, rows_out=i_stop - i_start, i_batch=i_batch)
+            return new_data
+
+        def write_batch(batch, new_data):
+            io.append_dataset_dict(f, new_data, overwrite=False)
+            commit_batch(f, batch[2])
+
+        # read the next batch and write the previous one while calculating
+        io.process_chunks(
+            sizer.iter_batches(rows_done, N), read_batch, compute_batch, write_batch)
 
 if __name__ == "__main__":
     FLAGS = parse_cmd()
@@ -5,9 +5,18 @@ import os
 import sys
 import time
 
+import h5py
+
 from ananke import io, config
+from ananke.bin import gmag_cut
 from ananke.logger import logger
 
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ()
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gal', required=True, type=str,
@@ -16,6 +25,10 @@ def parse_cmd():
                         help='LSR number of run')
     parser.add_argument('--rslice', required=True, type=int,
                         help='Radial slice of run')
+    parser.add_argument('--batch-size', required=False, type=int, default=10000000,
+                        help='Number of rows read at once per column')
+    parser.add_argument('--workers', required=False, type=int, default=1,
+                        help='Number of worker processes')
     return parser.parse_args()
 
 def main(FLAGS):
@@ -26,12 +39,8 @@ def main(FLAGS):
 
     ## Start script
     # get file information from galaxy, lsr, and rslice
-    ebf_path = os.path.join(
-        config.EBF_BASEDIR, f"{gal}/lsr-{lsr}",
-        f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced.ebf")
-    ebf_ext_path = os.path.join(
-        config.EBF_BASEDIR, f"{gal}/lsr-{lsr}",
-        f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced.ext.ebf")
+    ebf_path, ebf_ext_path = io.get_ebf_rslice_paths(
+        gal, lsr, rslice, config.EBF_BASEDIR)
     hdf5_path = os.path.join(
         config.HDF5_BASEDIR, f"{gal}/lsr-{lsr}",
         f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3.hdf5")
@@ -51,9 +60,17 @@ def main(FLAGS):
 
     # convert EBF format to HDF5 format
     io.ebf_to_hdf5(
-        ebf_path, hdf5_path, config.ALL_MOCK_KEYS)
+        ebf_path, hdf5_path, config.ALL_MOCK_KEYS,
+        block_size=FLAGS.batch_size, workers=FLAGS.workers)
     io.ebf_to_hdf5(
-        ebf_ext_path, hdf5_path, config.ALL_EXT_KEYS)
+        ebf_ext_path, hdf5_path, config.ALL_EXT_KEYS,
+        block_size=FLAGS.batch_size, workers=FLAGS.workers)
+
+    # count the stars passing the G magnitude cut once, so that the jobs of
+    # gmag_cut do not read all previous rows to find their row offset
+    logger.info("Count stars passing the G magnitude cut")
+    with h5py.File(hdf5_path, 'a') as f:
+        gmag_cut.write_gmag_counts(f, FLAGS.batch_size)
 
 if __name__ == "__main__":
     FLAGS = parse_cmd()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import argparse
+import h5py
+import os
+import time
+
+import numpy as np
+
+from ananke import io, config, metrics, selection, batching, kernels
+from ananke.logger import logger
+from ananke.rng import ChunkRNG
+from ananke.bin import gmag_cut, rotate_coords, calc_props, selection_function
+
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ('ijob', 'Njob', 'source', 'ext_var', 'ext_extrapolate',
+                 'err_extrapolate', 'seed')
+
+# Float64 columns created by process_batch per input row, when about a third
+# of the stars pass the G magnitude cut, for --memory-budget
+TEMP_COLUMNS = 80
+
+def parse_cmd():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gal', required=True, type=str,
+                         help='Galaxy name of run')
+    parser.add_argument('--lsr', required=True, type=int,
+                        help='LSR number of run')
+    parser.add_argument('--rslice', required=True, type=int,
+                        help='Radial slice of run')
+    parser.add_argument('--ijob', type=int, default=0, help='Job index')
+    parser.add_argument('--Njob', type=int, default=1, help='Total number of jobs')
+    parser.add_argument('--ext-extrapolate', required=False, action='store_true',
+                        help='Enable to extrapolate for extinction calculation')
+    parser.add_argument('--err-extrapolate', required=False, action='store_true',
+                        help='Enable to extrapolate for error calculation')
+    parser.add_argument('--ext-var', required=False, default='bminr',
+                        choices=('bminr', 'logteff'),
+                        help='Variable to calculate extinction coefficient')
+    parser.add_argument('--seed', required=False, type=int, default=0,
+                        help='Seed of the random number generator of the errors')
+    parser.add_argument('--batch-size', required=False, type=int, default=1000000,
+                        help='Batch size')
+    parser.add_argument('--source', required=False, default='hdf5',
+                        choices=('hdf5', 'ebf'),
+                        help='Read the converted HDF5 file or the Galaxia EBF files')
+    parser.add_argument('--memory-budget', required=False, type=batching.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 64G, to pick the batch size from '
+                             'instead of --batch-size')
+    parser.add_argument('--engine', required=False, default=kernels._DEFAULT_ENGINE,
+                        choices=kernels._ENGINES,
+                        help='Compute extinction, RV errors and the RVS selection with NumPy or compiled numba kernels')
+    return parser.parse_args()
+
+def process_batch(data, FLAGS, rng=None):
+    """ Run the full catalog chain on an in-memory batch of the converted rslice
+
+    `rng` is the random number generator positioned at the global row index of
+    the first star of the batch passing the G magnitude cut.
+    Returns the final batch, the RVS selection mask and the number of stars
+    passing the G magnitude cut.
+    """
+    # apply G magnitude cut
+    select = gmag_cut.calc_gmag_select(data)
+    data = {key: val[select] for key, val in data.items()}
+    num_gmag_select = select.sum()
+    if num_gmag_select == 0:
+        return data, select[select], num_gmag_select
+
+    # rotate coordinates and calculate properties
+    engine = getattr(FLAGS, 'engine', kernels._DEFAULT_ENGINE)
+    data.update(rotate_coords.calc_new_coords(data, FLAGS.lsr))
+    calc_props.calc_batch(
+        data, ext_var=FLAGS.ext_var, ext_extrapolate=FLAGS.ext_extrapolate,
+        err_extrapolate=FLAGS.err_extrapolate, rng=rng, engine=engine)
+
+    # apply general and RVS selection function
+    select = selection.calc_general_select(data)
+    data = {key: val[select] for key, val in data.items()}
+    select = selection.calc_rvs_select(data, engine=engine)
+    for key in selection_function.RVS_KEYS:
+        data[key][~select] = np.nan
+
+    return data, select, num_gmag_select
+
+def main(FLAGS):
+    """ Apply Gmag cut, rotate coordinates, calculate properties and apply
+    selection function in a single pass over the converted rslice """
+    gal = FLAGS.gal
+    lsr = FLAGS.lsr
+    rslice = FLAGS.rslice
+    ijob = FLAGS.ijob
+    Njob = FLAGS.Njob
+
+    # get file information from galaxy, lsr, and rslice
+    # read directly from the unsplit file to skip split_hdf5
+    in_path = os.path.join(
+        config.HDF5_BASEDIR, f"{gal}/lsr-{lsr}",
+        f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3.hdf5")
+    out_path = os.path.join(
+        config.DR3_BASEDIR, f"{gal}/lsr-{lsr}",
+        f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3.{ijob}.hdf5")
+
+    # create output directory if not already exists
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+    if FLAGS.source == 'ebf':
+        # read straight from the EBF files to skip ebf_to_hdf5
+        in_f = io.open_ebf_rslice(gal, lsr, rslice, config.EBF_BASEDIR)
+        in_path = ', '.join(in_f.filenames)
+    else:
+        in_f = h5py.File(in_path, 'r')
+
+    logger.info("Run fused catalog pipeline")
+    logger.info(f"In    : {in_path}")
+    logger.info(f"Dest  : {out_path}")
+
+    with in_f, h5py.File(out_path, 'w') as out_f:
+        # Add the same header as calc_props
+        out_f.attrs.update(calc_props.get_header(FLAGS))
+
+        # same row range as split_hdf5
+        num_samples = len(in_f['dmod_true'])
+        start = int(num_samples / Njob * ijob)
+        stop = int(num_samples / Njob * (ijob + 1))
+        N = stop - start
+        sizer = batching.get_batch_sizer(
+            FLAGS, [val for _, val in in_f.items()], TEMP_COLUMNS)
+
+        # same random numbers as the staged pipelines, see gmag_cut
+        rng = ChunkRNG(gal, lsr, rslice, seed=FLAGS.seed)
+        row_offset = gmag_cut.count_gmag_prefix(in_f, start, FLAGS.batch_size)
+        out_f.attrs['row_offset'] = row_offset
+
+        num_select_general = 0
+        num_select_rv = 0
+
+        def read_batch(batch):
+            # read each column of the batch only once
+            _, i_start, i_stop = batch
+            return {key: val[i_start: i_stop] for key, val in in_f.items()}
+
+        def compute_batch(batch, data):
+            nonlocal row_offset, num_select_general, num_select_rv
+            i_batch, i_start, i_stop = batch
+            N_batch = i_batch + sizer.num_batches(i_start, stop)
+            logger.info(f'Progress [{i_batch}/{N_batch}]')
+            data, select, num_gmag_select = process_batch(
+                data, FLAGS, rng=rng.at(row_offset))
+            row_offset += num_gmag_select
+            sizer.update(i_stop - i_start)
+            metrics.record_batch(
+                rows_in=i_stop - i_start, rows_out=len(select), i_batch=i_batch)
+            num_select_general += len(select)
+            num_select_rv += select.sum()
+            return data if len(select) > 0 else None
+
+        def write_batch(batch, data):
+            if data is not None:
+                io.append_dataset_dict(out_f, data)
+
+        # read the next batch and write the previous one while processing
+        io.process_chunks(
+            sizer.iter_batches(start, stop), read_batch, compute_batch, write_batch)
+
+        logger.info("Number of stars selected: {} / {}".format(
+            num_select_general, N))
+        logger.info("Number of RVS stars selected: {} / {}".format(
+            num_select_rv, num_select_general))
+        out_f.attrs.update(dict(
+            num_select_general=num_select_general, num_select_rv=num_select_rv))
+        metrics.record_rows(N, num_select_general)
+
+if __name__ == "__main__":
+    FLAGS = parse_cmd()
+
+    # run main and keep track of time
+    t0 = time.time()
+    main(FLAGS)
+    t1 = time.time()
+    logger.info(f"Total run time: {t1 - t0}")
+    logger.info("Done!")
@@ -7,10 +7,19 @@ import argparse
 import logging
 import time
 
-from ananke import extinction, io, config
+import numpy as np
+
+from ananke import extinction, io, config, metrics, batching
+from ananke.logger import logger
 
 FLAGS = None
 
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ('ijob', 'Njob', 'source')
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gal', required=True, type=str,
@@ -23,6 +32,13 @@ def parse_cmd():
     parser.add_argument('--Njob', type=int, default=1, help='Total number of jobs')
     parser.add_argument('--batch-size', required=False, type=int, default=1000000,
                         help='Batch size')
+    parser.add_argument('--source', required=False, default='hdf5',
+                        choices=('hdf5', 'ebf'),
+                        help='Read the split HDF5 file or the Galaxia EBF files')
+    parser.add_argument('--memory-budget', required=False, type=batching.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 64G, to pick the batch size from '
+                             'instead of --batch-size')
     return parser.parse_args()
 
 def set_logger():
@@ -34,6 +50,55 @@ def set_logger():
     logger.addHandler(stream_handler)
     return logger
 
+# Input columns of calc_gmag_select
+INPUT_KEYS = ('phot_g_mean_mag_abs', 'dmod_true')
+
+# Float64 columns created by calc_gmag_select per row, for --memory-budget
+TEMP_COLUMNS = 3
+
+# Float64 columns created per row when copying the selected rows of all
+# columns, relative to the number of columns, for --memory-budget
+COPY_TEMP_COLUMNS = 1
+
+# Number of rows per block of the G magnitude cut counts stored by ebf_to_hdf5
+GMAG_COUNT_BLOCK_SIZE = 1000000
+
+def calc_gmag_select(data, indices=(None, None)):
+    """ Calculate the G magnitude selection mask """
+    i_start, i_stop = indices
+    g_mag_abs = data['phot_g_mean_mag_abs'][i_start: i_stop]
+    dmod_true = data['dmod_true'][i_start: i_stop]
+    g_mag_int = extinction.abs_to_app(g_mag_abs, dmod_true)
+    return (3 <= g_mag_int) & (g_mag_int <= 21)
+
+def count_gmag_select(fobj, start, stop, batch_size):
+    """ Count the number of stars passing the G magnitude cut in a row range """
+    num_select = 0
+    for i_start in range(start, stop, batch_size):
+        i_stop = min(i_start + batch_size, stop)
+        num_select += calc_gmag_select(fobj, indices=(i_start, i_stop)).sum()
+    return int(num_select)
+
+def write_gmag_counts(fobj, batch_size, block_size=GMAG_COUNT_BLOCK_SIZE):
+    """ Store the number of stars passing the G magnitude cut per block of rows """
+    num_samples = len(fobj['dmod_true'])
+    counts = [
+        count_gmag_select(fobj, i_start, min(i_start + block_size, num_samples), batch_size)
+        for i_start in range(0, num_samples, block_size)]
+    fobj.attrs['gmag_counts'] = np.array(counts, dtype=np.int64)
+    fobj.attrs['gmag_count_block_size'] = block_size
+
+def count_gmag_prefix(fobj, stop, batch_size):
+    """ Count the number of stars passing the G magnitude cut in rows [0, stop),
+    from the per-block counts of write_gmag_counts if the file has them """
+    attrs = getattr(fobj, 'attrs', {})
+    if 'gmag_counts' not in attrs:
+        return count_gmag_select(fobj, 0, stop, batch_size)
+    block_size = int(attrs['gmag_count_block_size'])
+    num_blocks = stop // block_size
+    return (int(attrs['gmag_counts'][:num_blocks].sum())
+            + count_gmag_select(fobj, num_blocks * block_size, stop, batch_size))
+
 def main(FLAGS, LOGGER=None):
     """ Apply Gmag cut """
     gal = FLAGS.gal
@@ -41,13 +106,16 @@ def main(FLAGS, LOGGER=None):
     rslice = FLAGS.rslice
 
     if LOGGER is None:
-        LOGGER = set_logger()
+        LOGGER = logger
 
     ## Start script
     # keep track of time
     t0 = time.time()
 
     # get file information from galaxy, lsr, and rslice
+    src_path = os.path.join(
+        config.HDF5_BASEDIR, f"{gal}/lsr-{lsr}",
+        f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3.hdf5")
     in_path = os.path.join(
         config.HDF5_BASEDIR, f"{gal}/lsr-{lsr}",
         f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3.{FLAGS.ijob}.hdf5")
@@ -58,28 +126,96 @@ def main(FLAGS, LOGGER=None):
     # create output directory if not already exists
     os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
+    # Global row index of the first star of this job after the cut, i.e. the
+    # number of stars of the previous jobs passing the cut. This is the row
+    # counter of the random number generator of the error convolution.
+    # The converted rslice stores the counts per block of rows, so that only the
+    # last partial block is read. The EBF files have no counts and are read in full.
+    row_offset = 0
+    if FLAGS.source == 'ebf':
+        # read the row range of this job straight from the EBF files
+        with io.open_ebf_rslice(gal, lsr, rslice, config.EBF_BASEDIR) as src_f:
+            num_samples = len(src_f['dmod_true'])
+            start = int(num_samples / FLAGS.Njob * FLAGS.ijob)
+            stop = int(num_samples / FLAGS.Njob * (FLAGS.ijob + 1))
+            row_offset = count_gmag_prefix(src_f, start, FLAGS.batch_size)
+        in_f = io.open_ebf_rslice(gal, lsr, rslice, config.EBF_BASEDIR, start, stop)
+        in_path = ', '.join(in_f.filenames)
+    else:
+        if FLAGS.ijob > 0:
+            with h5py.File(src_path, 'r') as src_f:
+                num_samples = len(src_f['dmod_true'])
+                start = int(num_samples / FLAGS.Njob * FLAGS.ijob)
+                row_offset = count_gmag_prefix(src_f, start, FLAGS.batch_size)
+        in_f = h5py.File(in_path, 'r')
+
     # Apply G magnitude cut to the mock catalog
     LOGGER.info('Applying magnitude cut:')
     LOGGER.info(f'In  : {in_path}')
     LOGGER.info(f'Dest: {out_path}')
 
     out_f = h5py.File(out_path, 'w')
-    with h5py.File(in_path, 'r') as in_f:
+    out_f.attrs['row_offset'] = row_offset
+
+    with in_f:
         N = len(in_f['dmod_true'])
-        N_batch = (N + FLAGS.batch_size - 1) // FLAGS.batch_size
 
-        for i_batch in range(N_batch):
+        # First pass: calculate the selection masks from the G magnitude only.
+        # The masks of all rows are kept, and concatenated at the end
+        LOGGER.info('Calculating selection')
+        sizer = batching.get_batch_sizer(
+            FLAGS, [in_f[key] for key in INPUT_KEYS], TEMP_COLUMNS,
+            reserved_bytes=2 * N)
+        all_select = []
+
+        def compute_select(batch, data):
+            all_select.append(calc_gmag_select(data))
+            sizer.update(batch[2] - batch[1])
+
+        io.process_chunks(
+            sizer.iter_batches(0, N),
+            lambda batch: {key: in_f[key][batch[1]: batch[2]] for key in INPUT_KEYS},
+            compute_select)
+        all_select = np.concatenate(all_select)
+        num_select = int(all_select.sum())
+        LOGGER.info(f'Number of stars selected: {num_select} / {N}')
+        metrics.record_batch(rows_in=N, rows_out=num_select, phase='select')
+        metrics.record_rows(N, num_select)
+
+        # Second pass: preallocate all datasets and fill them with slice writes
+        for key, val in in_f.items():
+            io.preallocate_dataset(out_f, key, num_select, val.dtype)
+
+        # the mask of all rows is now part of the memory already used
+        columns = [val for _, val in in_f.items()]
+        sizer = batching.get_batch_sizer(
+            FLAGS, columns, COPY_TEMP_COLUMNS * len(columns))
+        out_start = 0
+
+        def read_batch(batch):
+            _, i_start, i_stop = batch
+            select = all_select[i_start: i_stop]
+            return {key: val[i_start: i_stop][select] for key, val in in_f.items()}
+
+        def compute_batch(batch, data):
+            nonlocal out_start
+            i_batch, i_start, i_stop = batch
+            N_batch = i_batch + sizer.num_batches(i_start, N)
             LOGGER.info(f'Progress [{i_batch}/{N_batch}]')
-            i_start = i_batch * FLAGS.batch_size
-            i_stop = i_start + FLAGS.batch_size
-
-            # Get G magnitude
-            g_mag_abs = in_f['phot_g_mean_mag_abs'][i_start: i_stop]
-            dmod_true = in_f['dmod_true'][i_start: i_stop]
-            g_mag_int = extinction.abs_to_app(g_mag_abs, dmod_true)
-            select = (3 <= g_mag_int) & (g_mag_int <= 21)
-            for key, val in in_f.items():
-                io.append_dataset(out_f, key, val[i_start: i_stop][select])
+            num_batch_select = all_select[i_start: i_stop].sum()
+            sizer.update(i_stop - i_start)
+            metrics.record_batch(
+                rows_in=i_stop - i_start, rows_out=num_batch_select, i_batch=i_batch)
+            out_start += num_batch_select
+            return out_start - num_batch_select, data
+
+        def write_batch(batch, result):
+            i_out, data = result
+            for key, val in data.items():
+                out_f[key][i_out: i_out + len(val)] = val
+
+        # read the next batch while writing the current one
+        io.process_chunks(sizer.iter_batches(0, N), read_batch, compute_batch, write_batch)
     out_f.close()
 
 if __name__ == "__main__":
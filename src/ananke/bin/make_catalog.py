@@ -3,8 +3,10 @@
 import argparse
 import os
 import time
+from contextlib import nullcontext
 from collections import OrderedDict
 
+from ananke import config, io, lineage, metrics, profiling, batching, kernels
 from ananke.logger import logger
 from ananke.bin import ebf_to_hdf5
 from ananke.bin import gmag_cut
@@ -12,6 +14,7 @@ from ananke.bin import split_hdf5
 from ananke.bin import rotate_coords
 from ananke.bin import calc_props
 from ananke.bin import selection_function
+from ananke.bin import fused_catalog
 
 
 ALL_PIPELINES = OrderedDict([
@@ -22,6 +25,7 @@ ALL_PIPELINES = OrderedDict([
     ("calc_props", calc_props),
     ("selection_function", selection_function),
 ])
+ALL_STAGES = OrderedDict(ALL_PIPELINES, fused_catalog=fused_catalog)
 
 def parse_cmd():
     parser = argparse.ArgumentParser()
@@ -42,11 +46,162 @@ def parse_cmd():
     parser.add_argument('--ext-var', required=False, default='bminr',
                         choices=('bminr', 'logteff'),
                         help='Variable to calculate extinction coefficient')
+    parser.add_argument('--seed', required=False, type=int, default=0,
+                        help='Seed of the random number generator of the errors')
+    parser.add_argument('--split-mode', required=False, default='virtual',
+                        choices=('virtual', 'copy'),
+                        help='Split into virtual datasets or physical copies')
+    parser.add_argument('--source', required=False, default='hdf5',
+                        choices=('hdf5', 'ebf'),
+                        help='Read the converted HDF5 file or the Galaxia EBF files')
     parser.add_argument('--which', type=str, default='both')
+    parser.add_argument('--fused', required=False, action='store_true',
+                        help='Run all pipelines in a single pass over the rslice')
+    parser.add_argument('--recompute', required=False, default=None,
+                        choices=('coords', 'extinction', 'errors'),
+                        help='Only recompute these columns in calc_props, '
+                             'and the errors that depend on them')
+    parser.add_argument('--profile', required=False, default=None, nargs='?',
+                        const='stage', choices=('stage', 'batch'),
+                        help='Profile each stage with cProfile and write its profile and '
+                             'a hot-spot summary next to the output. With batch, the '
+                             'summary also lists the hot spots of each batch')
+    parser.add_argument('--force', required=False, action='store_true',
+                        help='Rerun all pipelines even if their output is up to date')
     parser.add_argument('--batch-size', required=False, type=int, default=10000000,
                         help='Batch size')
+    parser.add_argument('--memory-budget', required=False, type=batching.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 64G, to pick the batch size of each '
+                             'stage from instead of --batch-size')
+    parser.add_argument('--workers', required=False, type=int, default=1,
+                        help='Number of worker processes in ebf_to_hdf5 and calc_props')
+    parser.add_argument('--engine', required=False, default=kernels._DEFAULT_ENGINE,
+                        choices=kernels._ENGINES,
+                        help='Compute extinction, RV errors and the RVS selection with '
+                             'NumPy or compiled numba kernels')
     return parser.parse_args()
 
+def get_stage_paths(pipeline, FLAGS):
+    """ Return the input files, as a list of (path, upstream stage), and the
+    output file of a stage """
+    gal = FLAGS.gal
+    lsr = FLAGS.lsr
+    rslice = FLAGS.rslice
+    ijob = FLAGS.ijob
+
+    name = f"lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3"
+    hdf5_path = os.path.join(config.HDF5_BASEDIR, f"{gal}/lsr-{lsr}", f"{name}.hdf5")
+    split_path = os.path.join(
+        config.HDF5_BASEDIR, f"{gal}/lsr-{lsr}", f"{name}.{ijob}.hdf5")
+    presf_path = os.path.join(
+        config.DR3_PRESF_BASEDIR, f"{gal}/lsr-{lsr}", f"{name}.{ijob}.hdf5")
+    dr3_path = os.path.join(config.DR3_BASEDIR, f"{gal}/lsr-{lsr}", f"{name}.{ijob}.hdf5")
+
+    ebf_inputs = [
+        (path, None) for path in io.get_ebf_rslice_paths(
+            gal, lsr, rslice, config.EBF_BASEDIR)]
+    if FLAGS.source == 'ebf':
+        source_inputs = ebf_inputs
+    else:
+        source_inputs = [(hdf5_path, 'ebf_to_hdf5')]
+
+    all_paths = {
+        'ebf_to_hdf5': (ebf_inputs, hdf5_path),
+        'split_hdf5': ([(hdf5_path, 'ebf_to_hdf5')], split_path),
+        'gmag_cut': (
+            source_inputs if FLAGS.source == 'ebf'
+            else [(split_path, 'split_hdf5')] + source_inputs, presf_path),
+        'rotate_coords': ([(presf_path, 'gmag_cut')], presf_path),
+        'calc_props': ([(presf_path, 'rotate_coords')], presf_path),
+        'selection_function': ([(presf_path, 'calc_props')], dr3_path),
+        'fused_catalog': (source_inputs, dr3_path),
+    }
+    return all_paths[pipeline]
+
+def get_record(pipeline, FLAGS):
+    """ Return the lineage record of a stage and its output file """
+    module = ALL_STAGES[pipeline]
+    inputs, out_path = get_stage_paths(pipeline, FLAGS)
+    record = lineage.make_record(
+        pipeline, module.VERSION, FLAGS, module.LINEAGE_FLAGS, inputs,
+        basedirs=(config.BASEDIR, config.EBF_BASEDIR))
+    return record, out_path
+
+def get_forced_stages(pipelines, FLAGS):
+    """ In-place stages cannot be rerun on their own output. If such a stage is
+    out of date but was already applied, its input must be produced again. """
+    forced = set()
+    for pipeline in pipelines:
+        if not getattr(ALL_STAGES[pipeline], 'INPLACE', False):
+            continue
+        record, out_path = get_record(pipeline, FLAGS)
+        if (lineage.read_record(out_path, pipeline) is not None
+                and not lineage.is_up_to_date(out_path, pipeline, record)):
+            inputs, _ = get_stage_paths(pipeline, FLAGS)
+            forced.update(upstream for _, upstream in inputs)
+    return forced
+
+def get_recompute_flags(FLAGS):
+    """ Return the arguments of calc_props with --recompute. Columns can only be
+    recomputed in place if the input of calc_props did not change since it ran,
+    e.g. because an upstream stage was rerun. Otherwise, run it in full """
+    record, out_path = get_record('calc_props', FLAGS)
+    if lineage.inputs_match(out_path, 'calc_props', record):
+        return FLAGS
+    logger.warning(
+        f"The input of calc_props changed since it last ran. "
+        f"Run it in full instead of recomputing {FLAGS.recompute}")
+    return argparse.Namespace(**dict(vars(FLAGS), recompute=None))
+
+def get_output_prefix(FLAGS):
+    """ Return the path prefix of the metrics and profiles of a job, which are
+    next to its final output """
+    _, out_path = get_stage_paths('selection_function', FLAGS)
+    return os.path.splitext(out_path)[0]
+
+def run_stage(pipeline, FLAGS, force=False):
+    """ Run a stage unless its output is up to date, and record its lineage and
+    performance metrics. Returns the run time """
+    metrics_path = get_output_prefix(FLAGS) + '.metrics.jsonl'
+    os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+    with metrics.record_stage(
+            metrics_path, pipeline, gal=FLAGS.gal, lsr=FLAGS.lsr, rslice=FLAGS.rslice,
+            ijob=FLAGS.ijob, Njob=FLAGS.Njob, batch_size=FLAGS.batch_size,
+            workers=FLAGS.workers) as recorder:
+        record, out_path = get_record(pipeline, FLAGS)
+        if not force and lineage.is_up_to_date(out_path, pipeline, record):
+            logger.info(f"Skipping {pipeline}: output is up to date")
+            recorder.status = 'skipped'
+            return 0
+        return _run_stage(pipeline, FLAGS, record, out_path)
+
+def _run_stage(pipeline, FLAGS, record, out_path):
+    """ Run a stage and record its lineage. Returns the run time """
+    # stages that write into their input file only produce the new columns
+    inputs, _ = get_stage_paths(pipeline, FLAGS)
+    inplace = any(path == out_path for path, _ in inputs)
+    columns_before = set()
+    if inplace:
+        stored = lineage.read_record(out_path, pipeline) or {}
+        columns_before = (
+            lineage.get_columns(out_path) - set(stored.get('columns', ())))
+
+    if FLAGS.profile is None:
+        profile = nullcontext()
+    else:
+        profile = profiling.profile_stage(
+            f'{get_output_prefix(FLAGS)}.{pipeline}', per_batch=FLAGS.profile == 'batch')
+
+    with profile:
+        t0 = time.time()
+        ALL_STAGES[pipeline].main(FLAGS)
+        t1 = time.time()
+
+    columns = lineage.get_columns(out_path) - columns_before
+    lineage.write_record(out_path, pipeline, record, columns)
+    return t1 - t0
+
 def main():
     """ Run all pipelines """
     FLAGS = parse_cmd()
@@ -55,26 +210,38 @@ def main():
         logger.info("Running pipeline: {}".format(FLAGS.pipeline))
         if FLAGS.pipeline not in ALL_PIPELINES:
             raise KeyError("Pipeline {} does not exist".format(FLAGS.pipeline))
-
-        t0 = time.time()
-        ALL_PIPELINES[FLAGS.pipeline].main(FLAGS)
-        t1 = time.time()
-        total_dt = t1 - t0
+        total_dt = run_stage(FLAGS.pipeline, FLAGS, force=True)
+    elif FLAGS.fused:
+        logger.info("Running fused pipeline")
+        logger.info("----------------------")
+        total_dt = run_stage("fused_catalog", FLAGS, force=FLAGS.force)
     else:
         logger.info("Running all pipelines")
         logger.info("---------------------")
-        total_dt = 0
+        pipelines = []
         for pipeline in ALL_PIPELINES:
-            # skipping this because EBF is unreliable and cannot be parallelized
+            # skipping this because it converts the whole rslice and must be run
+            # once before the rslice is split into jobs
             if pipeline == "ebf_to_hdf5":
                 continue
+            # gmag_cut reads the row range of the job from the EBF files directly
+            if pipeline == "split_hdf5" and FLAGS.source == "ebf":
+                continue
+            pipelines.append(pipeline)
+
+        forced = get_forced_stages(pipelines, FLAGS)
+        if FLAGS.recompute is not None:
+            forced.add('calc_props')
+        total_dt = 0
+        for pipeline in pipelines:
             logger.info("Running: {}".format(pipeline))
             logger.info("----------------------------------")
-            t0 = time.time()
-            ALL_PIPELINES[pipeline].main(FLAGS, logger)
-            t1 = time.time()
-            total_dt += t1 - t0
-            logger.info(f"Pipeline run time: {t1 - t0}")
+            stage_flags = FLAGS
+            if pipeline == 'calc_props' and FLAGS.recompute is not None:
+                stage_flags = get_recompute_flags(FLAGS)
+            dt = run_stage(pipeline, stage_flags, force=FLAGS.force or pipeline in forced)
+            total_dt += dt
+            logger.info(f"Pipeline run time: {dt}")
 
     logger.info(f"Total run time: {total_dt}")
     logger.info("Done!")
@@ -9,11 +9,20 @@ import numpy as np
 import astropy.coordinates as coord
 import astropy.units as u
 
-from ananke import photometric_utils, io, config
+from ananke import coordinates, photometric_utils, io, config, metrics, batching
 from ananke.logger import logger
 
 FLAGS = None
 
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ('lsr', )
+
+# The stage modifies its input file in place, so it cannot be rerun on its output
+INPLACE = True
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gal', required=True, type=str)
@@ -23,6 +32,10 @@ def parse_cmd():
     parser.add_argument('--Njob', type=int, default=1, help='Total number of jobs')
     parser.add_argument('--batch-size', required=False, type=int, default=1000000,
                         help='Batch size')
+    parser.add_argument('--memory-budget', required=False, type=batching.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 64G, to pick the batch size from '
+                             'instead of --batch-size')
     return parser.parse_args()
 
 def rotate_coords_ananke(x, lsr):
@@ -44,8 +57,48 @@ def rotate_coords_ananke(x, lsr):
     x_rot = np.dot(x, rot.T)
     return x_rot
 
-def calc_new_coords(data, lsr, indices=(None, None)):
+# Input columns of calc_new_coords
+INPUT_KEYS = ('px_true', 'py_true', 'pz_true', 'vx_true', 'vy_true', 'vz_true')
+
+# Float64 columns created by calc_new_coords per row, for --memory-budget
+TEMP_COLUMNS = 16
+
+def calc_new_coords(data, lsr, indices=(None, None),
+                    engine=coordinates._DEFAULT_ENGINE):
     """ Calculate new astrometric coordinates """
+    coordinates._check_engine(engine)
+    if engine == 'astropy':
+        return _calc_new_coords_astropy(data, lsr, indices)
+
+    istart, istop = indices
+    px_true = data['px_true'][istart: istop]
+    py_true = data['py_true'][istart: istop]
+    pz_true = data['pz_true'][istart: istop]
+    vx_true = data['vx_true'][istart: istop]
+    vy_true = data['vy_true'][istart: istop]
+    vz_true = data['vz_true'][istart: istop]
+
+    # rotate coordinate
+    px_rot, py_rot, pz_rot = rotate_coords_ananke(
+        np.stack([px_true, py_true, pz_true], 1), lsr).T
+    vx_rot, vy_rot, vz_rot = rotate_coords_ananke(
+        np.stack([vx_true, vy_true, vz_true], 1), lsr).T
+
+    # new coordinates
+    new_data = {}
+    new_data['px_true'] = px_rot
+    new_data['py_true'] = py_rot
+    new_data['vx_true'] = vx_rot
+    new_data['vy_true'] = vy_rot
+    new_data['ra_true'], new_data['dec_true'] = coordinates.cartesian_to_lonlat(
+        *coordinates.rotate(coordinates._GAL_TO_ICRS, px_rot, py_rot, pz_rot))
+    new_data['l_true'], new_data['b_true'] = coordinates.cartesian_to_lonlat(
+        px_rot, py_rot, pz_rot)
+
+    return new_data
+
+def _calc_new_coords_astropy(data, lsr, indices=(None, None)):
+    """ Calculate new astrometric coordinates using astropy """
     istart, istop = indices
     px_true = data['px_true'][istart: istop]
     py_true = data['py_true'][istart: istop]
@@ -98,17 +151,33 @@ def main(FLAGS):
 
     with h5py.File(in_path, 'a') as f:
         N = len(f['dmod_true'])
-        N_batch = (N + FLAGS.batch_size - 1) // FLAGS.batch_size
+        sizer = batching.get_batch_sizer(
+            FLAGS, [f[key] for key in INPUT_KEYS], TEMP_COLUMNS)
+
+        def read_batch(batch):
+            _, i_start, i_stop = batch
+            return {key: f[key][i_start: i_stop] for key in INPUT_KEYS}
 
-        for i_batch in range(N_batch):
+        def compute_batch(batch, data):
+            i_batch, i_start, i_stop = batch
+            N_batch = i_batch + sizer.num_batches(i_start, N)
             logger.info(f'Progress [{i_batch}/{N_batch}]')
-            i_start = i_batch * FLAGS.batch_size
-            i_stop = i_start + FLAGS.batch_size
-            indices = (i_start, i_stop)
-            new_data = calc_new_coords(f, lsr, indices=indices)
+            new_data = calc_new_coords(data, lsr)
+            sizer.update(i_stop - i_start)
+            metrics.record_batch(
+                rows_in=i_stop - i_start, rows_out=i_stop - i_start, i_batch=i_batch)
+            return new_data
+
+        def write_batch(batch, new_data):
+            _, i_start, i_stop = batch
             for key in new_data:
                 f[key][i_start: i_stop] = new_data[key]
 
+        # read the next batch and write the previous one while rotating
+        io.process_chunks(
+            sizer.iter_batches(0, N), read_batch, compute_batch, write_batch)
+        metrics.record_rows(N, N)
+
 if __name__ == "__main__":
     FLAGS = parse_cmd()
 
@@ -8,16 +8,50 @@ import time
 
 import numpy as np
 
-from ananke import io, config, selection
+from ananke import io, config, metrics, selection, batching, kernels
 from ananke.logger import logger
 
 FLAGS = None
+
+# Columns that are masked out for stars outside of the RVS selection
+RVS_KEYS = (
+    'radial_velocity',
+    'radial_velocity_error',
+    'radial_velocity_error_corr_factor',
+)
+
+# Input columns of the general and the RVS selection functions
+GENERAL_INPUT_KEYS = ('A0', 'phot_g_mean_mag', 'phot_bp_mean_mag', 'phot_rp_mean_mag')
+RVS_INPUT_KEYS = ('phot_g_mean_mag', 'phot_rp_mean_mag', 'logteff')
+
+# Float64 columns created per row by the general and the RVS selection
+# functions, and when copying the selected rows of a column, for --memory-budget
+GENERAL_TEMP_COLUMNS = 1
+RVS_TEMP_COLUMNS = 4
+COPY_TEMP_COLUMNS = 2
+
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ('which', )
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gal', required=True, type=str)
     parser.add_argument('--lsr', required=True, type=str)
     parser.add_argument('--rslice', required=True, type=int)
+    parser.add_argument('--ijob', type=int, default=0, help='Job index')
     parser.add_argument('--which', type=str, default='both')
+    parser.add_argument('--batch-size', required=False, type=int, default=1000000,
+                        help='Batch size')
+    parser.add_argument('--memory-budget', required=False, type=batching.parse_memory,
+                        default=None,
+                        help='Memory budget, e.g. 64G, to pick the batch size from '
+                             'instead of --batch-size')
+    parser.add_argument('--engine', required=False, default=kernels._DEFAULT_ENGINE,
+                        choices=kernels._ENGINES,
+                        help='Compute the RVS selection with NumPy or compiled numba kernels')
     return parser.parse_args()
 
 def main(FLAGS):
@@ -43,45 +77,106 @@ def main(FLAGS):
     if FLAGS.which in ('both', 'general'):
         logger.info("Apply general selection function")
         with h5py.File(in_path, 'r') as in_f:
-            # get selection mask
-            select = selection.calc_general_select(in_f)
-            logger.info("Number of stars selected: {} / {}".format(
-                select.sum(), len(select)))
+            N = len(in_f['dmod_true'])
+
+            # get selection mask, reading the next batch while selecting. The
+            # masks of all rows are kept, and concatenated at the end
+            sizer = batching.get_batch_sizer(
+                FLAGS, [in_f[key] for key in GENERAL_INPUT_KEYS], GENERAL_TEMP_COLUMNS,
+                reserved_bytes=2 * N)
+            all_select = []
+
+            def compute_select(batch, data):
+                all_select.append(selection.calc_general_select(data))
+                sizer.update(batch[2] - batch[1])
+
+            io.process_chunks(
+                sizer.iter_batches(0, N),
+                lambda batch: {
+                    key: in_f[key][batch[1]: batch[2]] for key in GENERAL_INPUT_KEYS},
+                compute_select)
+            all_select = np.concatenate(all_select)
+            num_select = int(all_select.sum())
+            logger.info("Number of stars selected: {} / {}".format(num_select, N))
+            metrics.record_batch(rows_in=N, rows_out=num_select, phase='select')
+            metrics.record_rows(N, num_select)
+
             # write to file
             with h5py.File(out_path, 'w') as out_f:
                 # copying headers
                 out_f.attrs.update(dict(in_f.attrs))
-                out_f.attrs.update(dict(num_select_general=select.sum()))
-                # copying all keys and apply selection function
-                for key in in_f:
+                out_f.attrs.update(dict(num_select_general=num_select))
+                # copying all keys and apply selection function batch by batch
+                # iterating over the items holds the h5py lock, which the
+                # reader thread of process_chunks needs, so list them first
+                items = list(in_f.items())
+                # one sizer for all keys, from the widest column
+                widest = max((val for _, val in items), key=lambda val: val.dtype.itemsize)
+                sizer = batching.get_batch_sizer(FLAGS, [widest], COPY_TEMP_COLUMNS)
+                for key, val in items:
                     logger.info(f"Copying key: {key}")
-                    data = in_f[key][:][select]
-                    out_f.create_dataset(key, data=data)
+                    out_data = io.preallocate_dataset(
+                        out_f, key, num_select, val.dtype)
+                    out_start = 0
+
+                    def read_batch(batch):
+                        _, i_start, i_stop = batch
+                        return val[i_start: i_stop][all_select[i_start: i_stop]]
+
+                    def compute_batch(batch, data):
+                        nonlocal out_start
+                        sizer.update(batch[2] - batch[1])
+                        out_start += len(data)
+                        return out_start - len(data), data
+
+                    def write_batch(batch, result):
+                        i_out, data = result
+                        out_data[i_out: i_out + len(data)] = data
+
+                    # read the next batch while writing the current one
+                    io.process_chunks(
+                        sizer.iter_batches(0, N), read_batch, compute_batch, write_batch)
+                    metrics.record_batch(
+                        rows_in=N, rows_out=num_select, phase='copy', key=key)
 
     if FLAGS.which in ('both', 'rvs'):
         logger.info("Apply RVS selection function")
         with h5py.File(out_path, 'a') as out_f:
-            # get RVS selection mask
-            select = selection.calc_rvs_select(out_f)
+            N = len(out_f['dmod_true'])
+            sizer = batching.get_batch_sizer(
+                FLAGS, [out_f[key] for key in RVS_INPUT_KEYS + RVS_KEYS], RVS_TEMP_COLUMNS)
+
+            def read_batch(batch):
+                _, i_start, i_stop = batch
+                return {
+                    key: out_f[key][i_start: i_stop]
+                    for key in RVS_INPUT_KEYS + RVS_KEYS}
+
+            def compute_batch(batch, data):
+                nonlocal num_select
+                select = selection.calc_rvs_select(
+                    data, engine=getattr(FLAGS, 'engine', kernels._DEFAULT_ENGINE))
+                num_select += select.sum()
+                for key in RVS_KEYS:
+                    data[key][~select] = np.nan
+                sizer.update(len(select))
+                metrics.record_batch(
+                    rows_in=len(select), rows_out=select.sum(), phase='rvs',
+                    i_batch=batch[0])
+                return {key: data[key] for key in RVS_KEYS}
+
+            def write_batch(batch, data):
+                _, i_start, i_stop = batch
+                for key, val in data.items():
+                    out_f[key][i_start: i_stop] = val
+
+            # get RVS selection mask and mask out RV batch by batch in place
+            num_select = 0
+            io.process_chunks(
+                sizer.iter_batches(0, N), read_batch, compute_batch, write_batch)
             logger.info("Number of RVS stars selected: {} / {}".format(
-                select.sum(), len(select)))
-            out_f.attrs.update(dict(num_select_rv=select.sum()))
-
-            rv  = out_f['radial_velocity'][:]
-            rv_error = out_f['radial_velocity_error'][:]
-            rv_error_corr = out_f['radial_velocity_error_corr_factor'][:]
-
-            del out_f["radial_velocity"]
-            del out_f["radial_velocity_error"]
-            del out_f["radial_velocity_error_corr_factor"]
-
-            rv[~select] = np.nan
-            rv_error[~select] = np.nan
-            rv_error_corr[~select] = np.nan
-            out_f.create_dataset("radial_velocity", data=rv)
-            out_f.create_dataset("radial_velocity_error", data=rv_error)
-            out_f.create_dataset("radial_velocity_error_corr_factor",
-                                 data=rv_error_corr)
+                num_select, N))
+            out_f.attrs.update(dict(num_select_rv=num_select))
 
 if __name__ == "__main__":
     FLAGS = parse_cmd()
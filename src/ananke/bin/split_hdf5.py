@@ -5,9 +5,15 @@ import h5py
 import os
 import time
 
-from ananke import config
+from ananke import config, metrics
 from ananke.logger import logger
 
+# Version of the stage, bump whenever its output changes
+VERSION = 1
+
+# Arguments that change the output of the stage
+LINEAGE_FLAGS = ('ijob', 'Njob', 'split_mode')
+
 def parse_cmd():
     parser = argparse.ArgumentParser()
     parser.add_argument('--gal', required=True, type=str,
@@ -18,8 +24,22 @@ def parse_cmd():
                         help='Radial slice of run')
     parser.add_argument('--ijob', type=int, default=0, help='Job index')
     parser.add_argument('--Njob', type=int, default=1, help='Total number of jobs')
+    parser.add_argument('--split-mode', required=False, default='virtual',
+                        choices=('virtual', 'copy'),
+                        help='Split into virtual datasets or physical copies')
     return parser.parse_args()
 
+def create_virtual_split(f_in, f_out, start, stop):
+    """ Create virtual datasets that map to the [start, stop) row range of each
+    dataset of the input file. No data is copied. """
+    # the source file is referred to by name relative to the directory of the
+    # output file, so the split files stay valid if both are moved together
+    src_name = os.path.basename(f_in.filename)
+    for key, val in f_in.items():
+        layout = h5py.VirtualLayout(shape=(stop - start, ), dtype=val.dtype)
+        layout[:] = h5py.VirtualSource(src_name, key, shape=val.shape)[start: stop]
+        f_out.create_virtual_dataset(key, layout)
+
 def main(FLAGS):
     """ Split HDF5 file into multiple files """
     gal = FLAGS.gal
@@ -40,8 +60,14 @@ def main(FLAGS):
         num_samples = len(f_in['dmod_true'])
         start = int(num_samples / Njob * ijob)
         stop = int(num_samples / Njob * (ijob + 1))
-        for key in f_in.keys():
-            f_out.create_dataset(key, data=f_in[key][start: stop])
+        metrics.record_rows(stop - start, stop - start)
+        if FLAGS.split_mode == 'virtual':
+            logger.info(f"Create virtual datasets of rows [{start}, {stop})")
+            create_virtual_split(f_in, f_out, start, stop)
+        else:
+            logger.info(f"Copy rows [{start}, {stop})")
+            for key in f_in.keys():
+                f_out.create_dataset(key, data=f_in[key][start: stop])
     f_out.close()
 
 if __name__ == "__main__":
@@ -3,8 +3,87 @@ import numpy as np
 import astropy.coordinates as coord
 import astropy.units as u
 
-def icrs_to_gal(data, postfix='', indices=(None, None)):
+# Rotation matrix from Galactic to ICRS Cartesian coordinates,
+# i.e. x_icrs = _GAL_TO_ICRS @ x_gal, as realized by astropy
+_GAL_TO_ICRS = np.array([
+    [-0.05487565771259163, 0.4941094371927268, -0.8676661375596576],
+    [-0.8734370519556159, -0.4448297212232952, -0.19807633727300053],
+    [-0.48383507361671546, 0.7469821839866676, 0.4559838136873016],
+])
+_ICRS_TO_GAL = _GAL_TO_ICRS.T
+
+# conversion from km/s to mas/yr * kpc (i.e. 1 AU / Julian year in km/s)
+_KMS_PER_MASYR_KPC = 4.740470463533348
+
+_ENGINES = ('numpy', 'astropy')
+_DEFAULT_ENGINE = 'numpy'
+
+def _check_engine(engine):
+    if engine not in _ENGINES:
+        raise ValueError(f'Unknown engine: {engine}')
+
+def rotate(matrix, x, y, z):
+    """ Apply a 3x3 rotation matrix to Cartesian components """
+    x_rot = matrix[0, 0] * x + matrix[0, 1] * y + matrix[0, 2] * z
+    y_rot = matrix[1, 0] * x + matrix[1, 1] * y + matrix[1, 2] * z
+    z_rot = matrix[2, 0] * x + matrix[2, 1] * y + matrix[2, 2] * z
+    return x_rot, y_rot, z_rot
+
+def cartesian_to_lonlat(x, y, z):
+    """ Convert Cartesian positions to longitude and latitude in degree """
+    lon = np.rad2deg(np.arctan2(y, x)) % 360.
+    lat = np.rad2deg(np.arctan2(z, np.hypot(x, y)))
+    return lon, lat
+
+def cartesian_to_spherical_vel(x, y, z, vx, vy, vz):
+    """ Project Cartesian velocities onto the spherical unit vectors
+
+    Returns the longitude, latitude and radial components of the velocity
+    and the distance
+    """
+    rho = np.hypot(x, y)
+    dist = np.hypot(rho, z)
+    v_rho = (x * vx + y * vy) / rho
+    v_lon = (x * vy - y * vx) / rho
+    v_lat = (rho * vz - z * v_rho) / dist
+    v_r = (rho * v_rho + z * vz) / dist
+    return v_lon, v_lat, v_r, dist
+
+def icrs_to_gal(data, postfix='', indices=(None, None), engine=_DEFAULT_ENGINE):
     """ Convert ICRS coordinate to Galactic """
+    _check_engine(engine)
+    if engine == 'astropy':
+        return _icrs_to_gal_astropy(data, postfix, indices)
+
+    i_start, i_stop = indices
+
+    if postfix != '':
+        postfix = '_' + postfix
+
+    ra = np.deg2rad(data[f'ra{postfix}'][i_start: i_stop])
+    dec = np.deg2rad(data[f'dec{postfix}'][i_start: i_stop])
+    pmra = data[f'pmra{postfix}'][i_start: i_stop]
+    pmdec = data[f'pmdec{postfix}'][i_start: i_stop]
+
+    # unit position vector and tangential proper motion vector in ICRS
+    cosra, sinra = np.cos(ra), np.sin(ra)
+    cosdec, sindec = np.cos(dec), np.sin(dec)
+    x, y, z = rotate(_ICRS_TO_GAL, cosdec * cosra, cosdec * sinra, sindec)
+    vx, vy, vz = rotate(
+        _ICRS_TO_GAL,
+        -pmra * sinra - pmdec * sindec * cosra,
+        pmra * cosra - pmdec * sindec * sinra,
+        pmdec * cosdec)
+
+    coord_data = {}
+    coord_data[f'l{postfix}'], coord_data[f'b{postfix}'] = cartesian_to_lonlat(x, y, z)
+    coord_data[f'pml{postfix}'], coord_data[f'pmb{postfix}'], _, _ = \
+        cartesian_to_spherical_vel(x, y, z, vx, vy, vz)
+
+    return coord_data
+
+def _icrs_to_gal_astropy(data, postfix='', indices=(None, None)):
+    """ Convert ICRS coordinate to Galactic using astropy """
     i_start, i_stop  = indices
 
     if postfix != '':
@@ -79,8 +158,43 @@ def rotate_coords_ananke(x, lsr):
     return x_rot
 
 
-def calc_coords(data, indices=(None, None)):
+def calc_coords(data, indices=(None, None), engine=_DEFAULT_ENGINE):
     """ Calculate all missing coordinates """
+    _check_engine(engine)
+    if engine == 'astropy':
+        return _calc_coords_astropy(data, indices)
+
+    i_start, i_stop = indices
+
+    coord_data = {}
+
+    # calculate parallax
+    dmod = data['dmod_true'][i_start: i_stop]
+    coord_data['parallax_true'] = 10**(2 - dmod / 5)
+
+    # calculate galactic proper motion and radial velocity
+    px = data['px_true'][i_start: i_stop]
+    py = data['py_true'][i_start: i_stop]
+    pz = data['pz_true'][i_start: i_stop]
+    vx = data['vx_true'][i_start: i_stop]
+    vy = data['vy_true'][i_start: i_stop]
+    vz = data['vz_true'][i_start: i_stop]
+    v_lon, v_lat, v_r, dist = cartesian_to_spherical_vel(px, py, pz, vx, vy, vz)
+    scale = 1 / (_KMS_PER_MASYR_KPC * dist)
+    coord_data['pml_true'] = v_lon * scale
+    coord_data['pmb_true'] = v_lat * scale
+    coord_data['radial_velocity_true'] = v_r
+
+    # calculate proper motion in ICRS
+    v_lon, v_lat, _, _ = cartesian_to_spherical_vel(
+        *rotate(_GAL_TO_ICRS, px, py, pz), *rotate(_GAL_TO_ICRS, vx, vy, vz))
+    coord_data['pmra_true'] = v_lon * scale
+    coord_data['pmdec_true'] = v_lat * scale
+
+    return coord_data
+
+def _calc_coords_astropy(data, indices=(None, None)):
+    """ Calculate all missing coordinates using astropy """
     i_start, i_stop = indices
 
     coord_data = {}
@@ -2,17 +2,26 @@
 from . import astrometric
 from . import photometric
 from . import spectroscopic
+from .. import kernels
 
-def calc_errors(data, indices=(None, None), extrapolate=False):
-    """ Calculate all errors """
+def calc_errors(data, indices=(None, None), extrapolate=False, rng=None,
+                engine=kernels._DEFAULT_ENGINE):
+    """ Calculate all errors
+
+    If rng is given, the error convolution draws from its counter-based streams
+    instead of the global NumPy random state. The engine is used for the
+    spectroscopic errors, see kernels
+    """
 
     err_data = {}
     err_data.update(
-        photometric.calc_uncertainties(data, indices, extrapolate=extrapolate))
+        photometric.calc_uncertainties(
+            data, indices, extrapolate=extrapolate, rng=rng))
     err_data.update(
-        astrometric.calc_uncertainties(data, indices))
+        astrometric.calc_uncertainties(data, indices, rng=rng))
     err_data.update(
-        spectroscopic.calc_uncertainties(data, indices, extrapolate=extrapolate))
+        spectroscopic.calc_uncertainties(
+            data, indices, extrapolate=extrapolate, rng=rng, engine=engine))
 
     return err_data
 
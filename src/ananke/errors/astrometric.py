@@ -5,13 +5,15 @@ import pygaia
 from pygaia.errors import astrometric
 
 from .. import coordinates
+from ..rng import get_rng
 
 _DEFAULT_RELEASE = 'dr3'
 
 def calc_uncertainties(
-        data, indices=(None, None), release=_DEFAULT_RELEASE):
+        data, indices=(None, None), release=_DEFAULT_RELEASE, rng=None):
     ''' Compute astrometric errors and compute the error-convolved data '''
     i_start, i_stop = indices
+    rng = get_rng(rng)
     uas_to_mas = u.uas.to(u.mas)   # conversion from micro-arcsec to milli-arcsec
     uas_to_deg = u.uas.to(u.deg)   # conversion from micro-arcsec to degree
     g_mag = data['phot_g_mean_mag_true'][i_start: i_stop]
@@ -30,6 +32,13 @@ def calc_uncertainties(
     # calculate RA and Dec error
     ra_cosdec_error, dec_error = astrometric.position_uncertainty(
         g_mag, release=release)
+
+    # calculate proper motion error in ICRS coord and convert to Ananke unit.
+    # These are the same uncertainties, so pygaia is only evaluated once
+    # note that pmra includes a factor cos(dec), i.e. pmra = pmra * cos(dec)
+    pmra_error = ra_cosdec_error * uas_to_mas
+    pmdec_error = dec_error * uas_to_mas
+
     cosdec = np.cos(np.deg2rad(dec_true))
     sindec = np.sin(np.deg2rad(dec_true))
     ra_error = np.sqrt(
@@ -38,23 +47,18 @@ def calc_uncertainties(
     dec_error = dec_error * uas_to_deg
     ra_error = ra_error * uas_to_deg
 
-    err_data['ra'] = np.random.normal(ra_true, ra_error)
-    err_data['dec'] = np.random.normal(dec_true, dec_error)
-    err_data['parallax'] = np.random.normal(parallax_true, parallax_error)
+    err_data['ra'] = rng.normal(ra_true, ra_error, 'ra')
+    err_data['dec'] = rng.normal(dec_true, dec_error, 'dec')
+    err_data['parallax'] = rng.normal(parallax_true, parallax_error, 'parallax')
     err_data['ra_error'] = ra_error
     err_data['dec_error'] = dec_error
     err_data['ra_cosdec_error'] = ra_cosdec_error
     err_data['parallax_error'] = parallax_error
     err_data['parallax_over_error'] = err_data['parallax'] / parallax_error
 
-    # calculate proper motion error in ICRS coord and convert to Ananke unit
-    # note that pmra includes a factor cos(dec), i.e. pmra = pmra * cos(dec)
-    pmra_error, pmdec_error = astrometric.position_uncertainty(g_mag, release=release)
-    pmra_error = pmra_error * uas_to_mas
-    pmdec_error = pmdec_error * uas_to_mas
-
-    err_data['pmra'] = np.random.normal(pmra_true, pmra_error)
-    err_data['pmdec'] = np.random.normal(pmdec_true, pmdec_error)
+    # error-convolve the proper motions
+    err_data['pmra'] = rng.normal(pmra_true, pmra_error, 'pmra')
+    err_data['pmdec'] = rng.normal(pmdec_true, pmdec_error, 'pmdec')
     err_data['pmra_error'] = pmra_error
     err_data['pmdec_error'] = pmdec_error
 
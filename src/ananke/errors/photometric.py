@@ -5,9 +5,20 @@ import numpy as np
 import pandas as pd
 import scipy.interpolate as interpolate
 
+from ..rng import get_rng
+
 _NOBS = {'G': 200, 'RP': 20, 'BP': 20}
 _SPLINE_CSV = os.path.join(os.path.dirname(__file__), "LogErrVsMagSpline.csv")
 
+# Number of grid points of the lookup tables, i.e. ~1 mmag spacing over 4-21 mag
+_LOOKUP_TABLE_NUM = 17001
+
+# Registries of spline tables, spline functions and lookup tables,
+# keyed by CSV path and (CSV path, band)
+_SPLINE_TABLES = {}
+_SPLINES = {}
+_LOOKUP_TABLES = {}
+
 def init_spline(spline_csv, band):
     """ Initialize spline function from CSV table
 
@@ -24,14 +35,57 @@ def init_spline(spline_csv, band):
         Cubic spline interpolation function
 
     """
-    df = pd.read_csv(spline_csv)
+    if spline_csv not in _SPLINE_TABLES:
+        _SPLINE_TABLES[spline_csv] = pd.read_csv(spline_csv)
+    df = _SPLINE_TABLES[spline_csv]
     band = band.upper()
     col_knots, col_coeff = f'knots_{band}', f'coeff_{band}'
 
     return interpolate.BSpline(
         df[col_knots].dropna(), df[col_coeff].dropna(), 3, extrapolate=False)
 
-def mag_uncertainties(band, mag, nobs=0, spline_csv=_SPLINE_CSV):
+def get_spline(band, spline_csv=_SPLINE_CSV):
+    """ Return the cached spline function of a band, initializing it on first use """
+    key = (spline_csv, band.upper())
+    if key not in _SPLINES:
+        _SPLINES[key] = init_spline(spline_csv, band)
+    return _SPLINES[key]
+
+def get_lookup_table(band, spline_csv=_SPLINE_CSV):
+    """ Return the cached lookup table of a band, initializing it on first use
+
+    The spline is tabulated on a uniform grid spanning its knots, i.e. the
+    4-21 mag range. Linear interpolation of the table agrees with the spline
+    to better than 1e-5 dex.
+
+    Returns
+    -------
+    mag_grid, log_u_mag_grid: ndarray, float
+        magnitude grid and log magnitude uncertainties on the grid
+    """
+    key = (spline_csv, band.upper())
+    if key not in _LOOKUP_TABLES:
+        spline = get_spline(band, spline_csv)
+        mag_grid = np.linspace(spline.t[0], spline.t[-1], _LOOKUP_TABLE_NUM)
+        _LOOKUP_TABLES[key] = (mag_grid, spline(mag_grid))
+    return _LOOKUP_TABLES[key]
+
+def interp_lookup_table(mag, mag_grid, log_u_mag_grid):
+    """ Linearly interpolate a lookup table on a uniform magnitude grid
+
+    Indices are computed directly from the grid spacing instead of a binary
+    search. Magnitudes outside of the grid return NaN.
+    """
+    num = len(mag_grid)
+    x = (mag - mag_grid[0]) * ((num - 1) / (mag_grid[-1] - mag_grid[0]))
+    with np.errstate(invalid='ignore'):
+        i = np.clip(x.astype(np.intp), 0, num - 2)
+    x -= i
+    log_u_mag = log_u_mag_grid[i] + x * (log_u_mag_grid[i + 1] - log_u_mag_grid[i])
+    log_u_mag[~((mag_grid[0] <= mag) & (mag <= mag_grid[-1]))] = np.nan
+    return log_u_mag
+
+def mag_uncertainties(band, mag, nobs=0, spline_csv=_SPLINE_CSV, lookup_table=False):
     """
     Estimate the mag uncertainties given mag
 
@@ -44,6 +98,8 @@ def mag_uncertainties(band, mag, nobs=0, spline_csv=_SPLINE_CSV):
     nobs : ndarray, int
         number of observations for which the uncertainties should be estimated.
         Must be a scalar integer value or an array of integer values.
+    lookup_table: bool
+        if True, interpolate the tabulated spline instead of evaluating it
     Returns
     -------
     u_mag: ndarray, float
@@ -59,43 +115,53 @@ def mag_uncertainties(band, mag, nobs=0, spline_csv=_SPLINE_CSV):
     if band not in ['G', 'BP', 'RP']:
         raise ValueError(f'Unknown band: {band}')
 
-    # initialize spline
-    spline = init_spline(spline_csv, band)
-
     # if magnitude is outside [4, 21], set to nearest bound
     #mag[mag <= 4] = 4.02
     #mag[mag >= 21.] = 20.98
     #mag = np.where((4. <= mag) & (mag <= 21.), mag, np.nan)
 
     # compute log error
-    log_u_mag = np.where(
-        nobs > 0,
-        spline(mag) - np.log10(np.sqrt(nobs) / np.sqrt(_NOBS[band])),
-        spline(mag),
-    )
+    if lookup_table:
+        mag_grid, log_u_mag_grid = get_lookup_table(band, spline_csv)
+        log_u_mag = interp_lookup_table(mag, mag_grid, log_u_mag_grid)
+    else:
+        log_u_mag = get_spline(band, spline_csv)(mag)
+    if np.any(nobs > 0):
+        with np.errstate(divide='ignore'):
+            log_u_mag = np.where(
+                nobs > 0,
+                log_u_mag - np.log10(np.sqrt(nobs) / np.sqrt(_NOBS[band])),
+                log_u_mag,
+            )
     u_mag = 10**log_u_mag
     return u_mag
 
-def calc_uncertainties(data, indices=(None, None), extrapolate=False):
+def calc_uncertainties(
+        data, indices=(None, None), extrapolate=False, lookup_table=False,
+        rng=None):
     """
     Calculate and return all magnitude errors and error-convolved magnitudes
     """
     i_start, i_stop = indices
+    rng = get_rng(rng)
     g_mag_true = data['phot_g_mean_mag_true'][i_start: i_stop]
     bp_mag_true = data['phot_bp_mean_mag_true'][i_start: i_stop]
     rp_mag_true = data['phot_rp_mean_mag_true'][i_start: i_stop]
 
     # calculate G, BP and RP errors
-    g_mag_error = mag_uncertainties('G', g_mag_true)
-    bp_mag_error = mag_uncertainties("BP", bp_mag_true)
-    rp_mag_error = mag_uncertainties("RP", rp_mag_true)
+    g_mag_error = mag_uncertainties('G', g_mag_true, lookup_table=lookup_table)
+    bp_mag_error = mag_uncertainties("BP", bp_mag_true, lookup_table=lookup_table)
+    rp_mag_error = mag_uncertainties("RP", rp_mag_true, lookup_table=lookup_table)
 
     err_data = {}
     err_data['phot_g_mean_mag_error'] = g_mag_error
     err_data['phot_bp_mean_mag_error'] = bp_mag_error
     err_data['phot_rp_mean_mag_error'] = rp_mag_error
-    err_data['phot_g_mean_mag'] = np.random.normal(g_mag_true, g_mag_error)
-    err_data['phot_bp_mean_mag'] = np.random.normal(bp_mag_true, bp_mag_error)
-    err_data['phot_rp_mean_mag'] = np.random.normal(rp_mag_true, rp_mag_error)
+    err_data['phot_g_mean_mag'] = rng.normal(
+        g_mag_true, g_mag_error, 'phot_g_mean_mag')
+    err_data['phot_bp_mean_mag'] = rng.normal(
+        bp_mag_true, bp_mag_error, 'phot_bp_mean_mag')
+    err_data['phot_rp_mean_mag'] = rng.normal(
+        rp_mag_true, rp_mag_error, 'phot_rp_mean_mag')
 
     return err_data
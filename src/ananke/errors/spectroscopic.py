@@ -1,6 +1,7 @@
 
 import numpy as np
-from .. import photometric_utils
+from .. import photometric_utils, kernels
+from ..rng import get_rng
 
 def rv_uncertainties(grvs, teff):
     """
@@ -24,23 +25,30 @@ def rv_uncertainties(grvs, teff):
     return rv_error, rv_error_corr
 
 def calc_uncertainties(
-    data, indices=(None, None), extrapolate=False):
+    data, indices=(None, None), extrapolate=False, rng=None,
+    engine=kernels._DEFAULT_ENGINE):
     """
     Calculate all spectroscopic uncertainties and error-convolved data
     """
+    kernels._check_engine(engine)
     i_start, i_stop = indices
+    rng = get_rng(rng)
     g_mag_true = data['phot_g_mean_mag_true'][i_start: i_stop]
     rp_mag_true = data['phot_rp_mean_mag_true'][i_start: i_stop]
     rv = data['radial_velocity_true'][i_start:i_stop]
-    teff = 10**data['logteff'][i_start:i_stop]
+    logteff = data['logteff'][i_start:i_stop]
 
     # Calculate G_RVS from G and R and calculate RV error from G_RVS and Teff
-    grvs_true = photometric_utils.gminr_to_grvsminr(
-        g_mag_true - rp_mag_true, extrapolate=extrapolate) + rp_mag_true
-    rv_error, rv_error_corr = rv_uncertainties(grvs_true, teff)
+    if engine == 'numba':
+        rv_error, rv_error_corr = kernels.rv_uncertainties(
+            g_mag_true, rp_mag_true, logteff, extrapolate=extrapolate)
+    else:
+        grvs_true = photometric_utils.gminr_to_grvsminr(
+            g_mag_true - rp_mag_true, extrapolate=extrapolate) + rp_mag_true
+        rv_error, rv_error_corr = rv_uncertainties(grvs_true, 10**logteff)
 
     err_data = {}
-    err_data['radial_velocity'] = np.random.normal(rv, rv_error)
+    err_data['radial_velocity'] = rng.normal(rv, rv_error, 'radial_velocity')
     err_data['radial_velocity_error'] = rv_error
     err_data['radial_velocity_error_corr_factor'] = rv_error_corr
 
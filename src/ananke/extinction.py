@@ -2,8 +2,16 @@
 
 import numpy as np
 
+from . import kernels
+
 _DEFAULT_BANDS = ('g', 'bp', 'rp')
 
+# Range of the variable of the extinction laws, normalized Teff or BP-RP
+_X_RANGES = {
+    'logteff': (3500./5040., 10000./5040.),
+    'bminr': (-0.06, 2.5),
+}
+
 _DEFAULT_LAWS_TEFF = {
     'g':  [0.259021858973784, 0.93676111876298, -0.43744649958549203,
            0.0783508476444952, -0.0013612743323522401, 0.000797222688660053,
@@ -34,6 +42,10 @@ _DEFAULT_LAWS_BMINR = {
            1.10476584967393e-05]
 }
 
+# Number of rows whose polynomial terms are evaluated at once in calc_extinction,
+# small enough for the terms to stay in cache
+_DESIGN_BLOCK_SIZE = 16384
+
 def abs_to_app(abs_mag, dmod):
     ''' Convert absolute magnitude to apparent magnitude given distance modulus '''
     return abs_mag + dmod
@@ -55,17 +67,12 @@ def app_to_ext(mag, band, a_0, X, ext_var, extrapolate=True):
     Returns:
     '''
     # Check which extinction law to use
+    X_min, X_max = _X_RANGES[ext_var]
     if ext_var == 'logteff':
-        X_min = 3500./5040.
-        X_max = 10000./5040.
-
         # Normalize Teff and set the extinction law coeff.
         X = (10**X)/5040
         coeff = _DEFAULT_LAWS_TEFF[band]
     elif ext_var == 'bminr':
-        X_min = -0.06
-        X_max = 2.5
-
         # Set the extinction law coeff.
         coeff = _DEFAULT_LAWS_BMINR[band]
 
@@ -83,12 +90,65 @@ def app_to_ext(mag, band, a_0, X, ext_var, extrapolate=True):
     return np.where((X < X_min) | (X > X_max), np.nan,
                     mag + k_mag*a_0)
 
+def get_ext_coeffs(bands, ext_var):
+    ''' Return the coefficients of the extinction laws of all bands
+    Args:
+    - bands: [list] bands, e.g. ('g', 'bp', 'rp')
+    - ext_var: [str] variable of the extinction laws, 'logteff' or 'bminr'
+
+    Returns:
+    - coeffs: [array] (bands, 10) coefficients, in the order of the terms of ext_design
+    '''
+    if ext_var == 'logteff':
+        laws = _DEFAULT_LAWS_TEFF
+    elif ext_var == 'bminr':
+        laws = _DEFAULT_LAWS_BMINR
+    else:
+        raise ValueError(f'Unknown extinction variable: {ext_var}')
+    return np.array([laws[band] for band in bands], dtype=np.float64)
+
+def ext_design(X, a_0, out=None):
+    ''' Calculate the polynomial terms in X and A0 of the extinction laws
+    Args:
+    - X: [array] normalized Teff or BP-RP
+    - a_0: [array] extinction A0
+    - out: [array] optional (10, N) output array
+
+    Returns:
+    - design: [array] (10, N) terms 1, X, X^2, X^3, A0, A0^2, A0^3, X A0, A0 X^2, X A0^2
+    '''
+    if out is None:
+        out = np.empty((10, len(X)))
+    X2 = X * X
+    a_02 = a_0 * a_0
+    out[0] = 1.
+    out[1] = X
+    out[2] = X2
+    np.multiply(X2, X, out=out[3])
+    out[4] = a_0
+    out[5] = a_02
+    np.multiply(a_02, a_0, out=out[6])
+    np.multiply(X, a_0, out=out[7])
+    np.multiply(a_0, X2, out=out[8])
+    np.multiply(X, a_02, out=out[9])
+    return out
+
 def calc_extinction(
     data, bands=_DEFAULT_BANDS, indices=(None, None),
-    ext_var='bminr', extrapolate=True):
-    ''' Calculate all extincted magnitude '''
+    ext_var='bminr', extrapolate=True, engine=kernels._DEFAULT_ENGINE):
+    ''' Calculate all extincted magnitude
+
+    The extinction laws of all bands are evaluated at once as the product of
+    their coefficients with the polynomial terms of X and A0, block by block
+    so that the terms stay in cache.
+    '''
+    kernels._check_engine(engine)
+    if engine == 'numba':
+        return _calc_extinction_numba(data, bands, indices, ext_var, extrapolate)
 
     i_start, i_stop = indices
+    coeffs = get_ext_coeffs(bands, ext_var)
+    X_min, X_max = _X_RANGES[ext_var]
 
     # read distance modulus
     dmod = data['dmod_true'][i_start: i_stop]
@@ -97,24 +157,34 @@ def calc_extinction(
     # read extinction coefficient
     a_0 = data['A0'][i_start: i_stop]
 
-    # iterate over all bands
+    # read the variable of the extinction laws, normalized Teff or BP-RP
+    if ext_var == 'logteff':
+        X = (10**data['logteff'][i_start: i_stop])/5040
+    else:
+        X = (data['phot_bp_mean_mag_abs'][i_start: i_stop]
+             - data['phot_rp_mean_mag_abs'][i_start: i_stop])
+    if extrapolate:
+        X[X < X_min] = X_min
+        X[X > X_max] = X_max
+
+    # extinction of all bands, k_mag * A0
+    dtype = np.result_type(dmod, a_0, X)
+    coeffs = coeffs.astype(dtype)
+    ext_mag = np.empty((len(bands), N_batch), dtype=dtype)
+    design = np.empty((10, min(N_batch, _DESIGN_BLOCK_SIZE)), dtype=dtype)
+    for i in range(0, N_batch, _DESIGN_BLOCK_SIZE):
+        j = min(i + _DESIGN_BLOCK_SIZE, N_batch)
+        np.matmul(coeffs, ext_design(X[i: j], a_0[i: j], design[:, :j - i]),
+                  out=ext_mag[:, i: j])
+    ext_mag *= a_0
+    ext_mag[:, (X < X_min) | (X > X_max)] = np.nan
+
     ext_data = {}
-    for band in bands:
-        # Calculate unextincted apparent magnitude
+    for band, phot_mean_mag_true in zip(bands, ext_mag):
+        # Calculate unextincted and extincted apparent magnitude
         phot_mean_mag_abs = data[f'phot_{band}_mean_mag_abs'][i_start: i_stop]
         phot_mean_mag_int = abs_to_app(phot_mean_mag_abs, dmod)
-
-        # Calculate extincted apparent magnitude
-        if ext_var == 'logteff':
-            logteff = data['logteff'][i_start:i_stop]
-            phot_mean_mag_true = app_to_ext(
-                phot_mean_mag_int, band, a_0, logteff, ext_var, extrapolate=extrapolate)
-        elif ext_var == 'bminr':
-            bp_mag_true = data['phot_bp_mean_mag_abs'][i_start: i_stop]
-            rp_mag_true = data['phot_rp_mean_mag_abs'][i_start: i_stop]
-            phot_mean_mag_true = app_to_ext(
-                phot_mean_mag_int, band, a_0, bp_mag_true-rp_mag_true, ext_var,
-                extrapolate=extrapolate)
+        phot_mean_mag_true += phot_mean_mag_int
 
         # Store the results
         ext_data[f'phot_{band}_mean_mag_int'] = phot_mean_mag_int
@@ -132,3 +202,18 @@ def calc_extinction(
 
     return ext_data
 
+def _calc_extinction_numba(
+    data, bands=_DEFAULT_BANDS, indices=(None, None), ext_var='bminr', extrapolate=True):
+    ''' Calculate all extincted magnitude with the compiled kernel '''
+    if tuple(bands) != _DEFAULT_BANDS:
+        raise ValueError(f'The numba engine only supports the bands {_DEFAULT_BANDS}')
+    coeffs = get_ext_coeffs(bands, ext_var)
+
+    i_start, i_stop = indices
+    return kernels.calc_extinction(
+        data['dmod_true'][i_start: i_stop], data['A0'][i_start: i_stop],
+        data['phot_g_mean_mag_abs'][i_start: i_stop],
+        data['phot_bp_mean_mag_abs'][i_start: i_stop],
+        data['phot_rp_mean_mag_abs'][i_start: i_stop],
+        data['logteff'][i_start: i_stop], coeffs,
+        ext_var=ext_var, extrapolate=extrapolate, X_range=_X_RANGES[ext_var])
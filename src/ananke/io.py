@@ -1,9 +1,14 @@
 
+import glob
 import h5py
 import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import numpy as np
 
+from . import config
 from .logger import logger
 try:
     import ebf
@@ -27,18 +32,280 @@ def get_rslice_path(gal, lsr, rslice, ijob=None, basedir=None):
         raise FileNotFoundError(f'{path} does not exist.')
     return path
 
-def read_rslice(keys, gal, lsr, rslice, basedir, ijobs=[0, ]):
-    ''' Iterate through all indices of an rslice and read data into dict '''
-    data = {k: [] for k in keys}
-    for i in ijobs:
-        path = get_rslice_path(gal, lsr, rslice, i, basedir=basedir)
-        with h5py.File(path, 'r') as f:
-            for k in keys:
-                data[k].append(f[k][:])
-    for k in keys:
-        data[k] = np.concatenate(data[k])
+def get_ebf_rslice_paths(gal, lsr, rslice, basedir):
+    ''' Get the paths of the ebf mock catalog and extinction files of an rslice '''
+    path = os.path.join(
+        basedir, f'{gal}/lsr-{lsr}', f'lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced')
+    return path + '.ebf', path + '.ext.ebf'
+
+def open_ebf_rslice(gal, lsr, rslice, basedir, start=None, stop=None):
+    ''' Open the ebf mock catalog and extinction files of an rslice as an EBFFile
+    with the same column names as the converted hdf5 file '''
+    ebf_path, ebf_ext_path = get_ebf_rslice_paths(gal, lsr, rslice, basedir)
+    return EBFFile(
+        {ebf_path: config.ALL_MOCK_KEYS, ebf_ext_path: config.ALL_EXT_KEYS},
+        start=start, stop=stop)
+
+# Default number of threads reading the per-job rslice files
+_DEFAULT_READ_WORKERS = 8
+
+def get_raw_extents(dset):
+    ''' Return the byte offsets in the file of the rows of an hdf5 dataset
+    as a list of (offset, row start, row stop), merging adjacent extents.
+    Returns None if the data cannot be read directly from the file, e.g. if
+    it is compressed, virtual, not allocated, or not in native byte order '''
+    if (dset.ndim != 1 or dset.is_virtual or dset.external is not None
+            or not dset.dtype.isnative
+            or dset.id.get_create_plist().get_nfilters() > 0):
+        return None
+    num_samples = len(dset)
+    if dset.chunks is None:
+        offset = dset.id.get_offset()
+        return None if offset is None else [(offset, 0, num_samples)]
+
+    chunk_infos = []
+    if hasattr(dset.id, 'chunk_iter'):
+        dset.id.chunk_iter(chunk_infos.append)
+    else:
+        # get_chunk_info is linear in the number of chunks, so this is quadratic
+        chunk_infos = [dset.id.get_chunk_info(i) for i in range(dset.id.get_num_chunks())]
+    chunk_size = dset.chunks[0]
+    extents = sorted(
+        ((info.byte_offset, info.chunk_offset[0],
+          min(info.chunk_offset[0] + chunk_size, num_samples)) for info in chunk_infos),
+        key=lambda extent: extent[1])
+
+    merged = []
+    itemsize = dset.dtype.itemsize
+    for offset, start, stop in extents:
+        if merged and merged[-1][2] == start and (
+                merged[-1][0] + (start - merged[-1][1]) * itemsize == offset):
+            merged[-1] = (merged[-1][0], merged[-1][1], stop)
+        elif (merged[-1][2] if merged else 0) == start:
+            merged.append((offset, start, stop))
+        else:
+            # unallocated chunks are read as the fill value by hdf5
+            return None
+    if (merged[-1][2] if merged else 0) != num_samples:
+        return None
+    return merged
+
+def _pread_into(fd, buffer, offset):
+    ''' Read from a file descriptor at an offset until the buffer is full '''
+    buffer = memoryview(buffer).cast('B')
+    while len(buffer) > 0:
+        num_bytes = os.preadv(fd, [buffer], offset)
+        if num_bytes == 0:
+            raise EOFError(f"Unexpected end of file at byte {offset}")
+        buffer = buffer[num_bytes:]
+        offset += num_bytes
+
+def read_rslice(keys, gal, lsr, rslice, basedir, ijobs=[0, ],
+                workers=_DEFAULT_READ_WORKERS):
+    ''' Read the keys of the per-job files of an rslice into a dict of arrays.
+
+    The arrays are preallocated from the dataset shapes and each file and column
+    is read into its slice, concurrently with a pool of `workers` threads.
+    Contiguous or uncompressed chunked columns are read straight from the file
+    with `pread`, outside of h5py, whose global lock would serialize the reads.
+    Other columns, and columns whose dtype or length differs from the output,
+    fall back to `read_direct`, which converts them to the output dtype.
+    '''
+    paths = [get_rslice_path(gal, lsr, rslice, i, basedir=basedir) for i in ijobs]
+    files = [h5py.File(path, 'r') for path in paths]
+    fds = []
+    try:
+        # row offset of each file in the output arrays
+        lengths = [len(f[keys[0]]) if len(keys) > 0 else 0 for f in files]
+        offsets = np.cumsum([0] + lengths)
+        # the dtype of each column is the common dtype of all files, as with np.concatenate
+        data = {
+            key: np.empty(offsets[-1], dtype=np.result_type(*[f[key].dtype for f in files]))
+            for key in keys}
+
+        # collect the reads of each file and column
+        direct_reads = []
+        raw_reads = []
+        for f, length, out_start in zip(files, lengths, offsets[:-1]):
+            fd = os.open(f.filename, os.O_RDONLY) if hasattr(os, 'preadv') else None
+            if fd is not None:
+                fds.append(fd)
+            for key in keys:
+                extents = None
+                if (fd is not None and f[key].dtype == data[key].dtype
+                        and len(f[key]) == length):
+                    extents = get_raw_extents(f[key])
+                if extents is None:
+                    direct_reads.append((f[key], data[key], out_start, length))
+                    continue
+                for offset, start, stop in extents:
+                    out = data[key][out_start + start: out_start + stop]
+                    raw_reads.append((fd, out, offset))
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_pread_into, *args) for args in raw_reads]
+            # h5py reads hold its global lock, so run them in this thread
+            for dset, out, out_start, length in direct_reads:
+                if length > 0:
+                    dset.read_direct(
+                        out, source_sel=np.s_[0: length],
+                        dest_sel=np.s_[out_start: out_start + length])
+            for future in futures:
+                future.result()
+    finally:
+        for fd in fds:
+            os.close(fd)
+        for f in files:
+            f.close()
     return data
 
+# Default number of rows per chunk when iterating over a Catalog
+_DEFAULT_CATALOG_CHUNK_SIZE = 1000000
+
+def _parse_rslice_path(path):
+    ''' Return the rslice and job index of a per-job rslice file, or None '''
+    match = re.search(r'rslice-(\d+)\..*-res7100-md-sliced-gcat-dr3\.(\d+)\.hdf5$', path)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+class Catalog:
+    ''' Lazy columnar reader over the per-job hdf5 files of one or more rslices.
+
+    Nothing is read until iterating over the chunks of the catalog or calling
+    `read`. `select` restricts the columns to read, and `where` adds a predicate
+    that is evaluated chunk by chunk from its own columns before the other
+    columns of the chunk are read. Both return a new Catalog. For example:
+    ```
+    catalog = Catalog.from_rslice(gal, lsr, rslice, config.DR3_BASEDIR)
+    data = catalog.select('l', 'b', 'parallax').where(
+        lambda d: d['parallax_over_error'] > 10, 'parallax_over_error').read()
+    ```
+
+    Args:
+    - paths: [list] paths of the hdf5 files
+    - keys: [list] columns to read. Default to all columns of the first file
+    - predicates: [list] list of (function, keys). The function takes a dict of
+    the columns `keys` of a chunk and returns a boolean mask of its rows
+    - chunk_size: [int] number of rows per chunk
+    '''
+    def __init__(self, paths, keys=None, predicates=(),
+                 chunk_size=_DEFAULT_CATALOG_CHUNK_SIZE):
+        self.paths = list(paths)
+        self.keys = None if keys is None else list(keys)
+        self.predicates = list(predicates)
+        self.chunk_size = int(chunk_size)
+
+    @classmethod
+    def from_rslice(cls, gal, lsr, rslice, basedir, ijobs=None, **kwargs):
+        ''' Catalog of the per-job files of an rslice. Default to all existing jobs '''
+        if ijobs is None:
+            pattern = os.path.join(
+                basedir, f'{gal}/lsr-{lsr}',
+                f'lsr-{lsr}-rslice-{rslice}.{gal}-res7100-md-sliced-gcat-dr3.*.hdf5')
+            paths = [path for path in glob.glob(pattern) if _parse_rslice_path(path)]
+            if len(paths) == 0:
+                raise FileNotFoundError(f'No files match {pattern}')
+            paths = sorted(paths, key=_parse_rslice_path)
+        else:
+            paths = [get_rslice_path(gal, lsr, rslice, i, basedir=basedir) for i in ijobs]
+        return cls(paths, **kwargs)
+
+    @classmethod
+    def from_galaxy(cls, gal, lsr, basedir, rslices=None, **kwargs):
+        ''' Catalog of the per-job files of all rslices of a galaxy and LSR.
+        Default to all existing rslices '''
+        pattern = os.path.join(
+            basedir, f'{gal}/lsr-{lsr}',
+            f'lsr-{lsr}-rslice-*.{gal}-res7100-md-sliced-gcat-dr3.*.hdf5')
+        paths = [path for path in glob.glob(pattern) if _parse_rslice_path(path)]
+        if rslices is not None:
+            paths = [path for path in paths if _parse_rslice_path(path)[0] in rslices]
+        if len(paths) == 0:
+            if rslices is None:
+                raise FileNotFoundError(f'No files match {pattern}')
+            raise FileNotFoundError(f'No files of rslices {list(rslices)} match {pattern}')
+        return cls(sorted(paths, key=_parse_rslice_path), **kwargs)
+
+    def select(self, *keys):
+        ''' Return a catalog that only reads the given columns '''
+        return Catalog(self.paths, keys, self.predicates, self.chunk_size)
+
+    def where(self, predicate, *keys):
+        ''' Return a catalog that only keeps the rows where `predicate`, a
+        function of a dict of the columns `keys`, is True '''
+        predicates = self.predicates + [(predicate, keys)]
+        return Catalog(self.paths, self.keys, predicates, self.chunk_size)
+
+    def _iter_masks(self, f):
+        ''' Iterate over the chunks of an open file. Yield the row range, the
+        mask of the rows passing all predicates and the predicate columns '''
+        num_samples = len(f[next(iter(f.keys()))])
+        for start in range(0, num_samples, self.chunk_size):
+            stop = min(start + self.chunk_size, num_samples)
+            columns = {}
+            mask = np.ones(stop - start, dtype=bool)
+            for predicate, keys in self.predicates:
+                for key in keys:
+                    if key not in columns:
+                        columns[key] = f[key][start: stop]
+                mask &= predicate({key: columns[key] for key in keys})
+            yield start, stop, mask, columns
+
+    def iter_chunks(self):
+        ''' Iterate over the chunks of all files. Yield a dict of the selected
+        columns of the rows passing all predicates '''
+        for path in self.paths:
+            with h5py.File(path, 'r') as f:
+                keys = list(f.keys()) if self.keys is None else self.keys
+                for start, stop, mask, columns in self._iter_masks(f):
+                    num_select = mask.sum()
+                    if num_select == 0:
+                        continue
+                    chunk = {}
+                    for key in keys:
+                        data = columns.get(key)
+                        if data is None:
+                            data = f[key][start: stop]
+                        chunk[key] = data if num_select == len(mask) else data[mask]
+                    yield chunk
+
+    def __iter__(self):
+        return self.iter_chunks()
+
+    def count(self):
+        ''' Return the number of rows passing all predicates. Only the
+        predicate columns are read '''
+        num = 0
+        for path in self.paths:
+            with h5py.File(path, 'r') as f:
+                num += sum(int(mask.sum()) for _, _, mask, _ in self._iter_masks(f))
+        return num
+
+    def read(self):
+        ''' Read the selected columns of the rows passing all predicates into a dict '''
+        if len(self.paths) == 0:
+            raise ValueError('Cannot read a catalog without files')
+        chunks = list(self.iter_chunks())
+        if len(chunks) == 0:
+            with h5py.File(self.paths[0], 'r') as f:
+                keys = list(f.keys()) if self.keys is None else self.keys
+                return {key: np.empty(0, dtype=f[key].dtype) for key in keys}
+        return {key: np.concatenate([chunk[key] for chunk in chunks]) for key in chunks[0]}
+
+# Default number of rows per HDF5 chunk of preallocated datasets (1 MB of float64)
+_DEFAULT_CHUNK_SIZE = 131072
+
+# Default number of rows per block when converting ebf files
+_DEFAULT_EBF_BLOCK_SIZE = 10000000
+
+def preallocate_dataset(fobj, key, num, dtype, chunk_size=_DEFAULT_CHUNK_SIZE):
+    ''' Create an hdf5 dataset at its final size to be filled with slice writes.
+    The dataset stays resizable so that it can still be appended '''
+    chunk_size = max(1, min(num, chunk_size))
+    return fobj.create_dataset(
+        key, shape=(num, ), dtype=dtype, maxshape=(None,), chunks=(chunk_size, ))
+
 def append_dataset(fobj, key, data, overwrite=False):
     ''' Append an hdf5 dataset '''
     if fobj.get(key) is None:
@@ -59,13 +326,139 @@ def append_dataset_dict(fobj, data_dict, overwrite=False):
     for key, data in data_dict.items():
         append_dataset(fobj, key, data, overwrite)
 
-def ebf_to_hdf5(infile, outfile, keys):
+class ColumnCache:
+    ''' In-memory columns of a row range of a file, each read at most once.
+
+    A column is read from the file the first time it is accessed and then
+    kept in memory. Columns computed from them are added with item assignment
+    or `update`, shadow the columns of the file, and are returned by
+    `computed`. The cache can be given in place of the file, with the default
+    indices, to the functions of coordinates, extinction, errors and selection.
+    Iterating over the cache only yields the columns in memory.
+
+    Args:
+    - fobj: [h5py.File, EBFFile or dict] file or columns to read from
+    - start, stop: [int] row range of the cache
+    - keys: [list] columns to read right away, e.g. on a reader thread
+    '''
+    def __init__(self, fobj, start=None, stop=None, keys=()):
+        self.fobj = fobj
+        self.start = start
+        self.stop = stop
+        self._columns = {}
+        self._computed = {}
+        for key in keys:
+            self[key]
+
+    def __getitem__(self, key):
+        if key not in self._columns:
+            self._columns[key] = self.fobj[key][self.start: self.stop]
+        return self._columns[key]
+
+    def __setitem__(self, key, val):
+        self._columns[key] = val
+        self._computed[key] = val
+
+    def __contains__(self, key):
+        return key in self._columns or key in self.fobj
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def keys(self):
+        return self._columns.keys()
+
+    def items(self):
+        return self._columns.items()
+
+    def update(self, data):
+        for key, val in data.items():
+            self[key] = val
+
+    def computed(self):
+        ''' Return the dict of computed columns, in the order they were added '''
+        return dict(self._computed)
+
+# Functions called at the start of the reader and writer threads of
+# process_chunks, e.g. to profile them, see add_thread_initializer
+_THREAD_INITIALIZERS = []
+
+def add_thread_initializer(func):
+    ''' Call `func` at the start of every reader and writer thread of process_chunks '''
+    _THREAD_INITIALIZERS.append(func)
+
+def remove_thread_initializer(func):
+    ''' Stop calling `func` at the start of the reader and writer threads '''
+    _THREAD_INITIALIZERS.remove(func)
+
+def _init_thread():
+    ''' Call the initializers of a reader or writer thread '''
+    for func in list(_THREAD_INITIALIZERS):
+        func()
+
+def process_chunks(chunks, read_func, compute_func, write_func=None, threads=True):
+    ''' Run a chunked read-compute-write loop with read-ahead and write-behind.
+
+    While chunk i is computed on the calling thread, chunk i+1 is read on a
+    reader thread and the result of chunk i-1 is written on a writer thread,
+    so at most three chunks are in memory. Reads and writes each stay in chunk
+    order. With `threads=False`, the loop runs serially on the calling thread.
+
+    Args:
+    - chunks: [iterable] chunks, e.g. the output of batching.BatchSizer.iter_batches.
+    It is consumed lazily, one chunk ahead of the one being computed
+    - read_func: function of a chunk returning its input data
+    - compute_func: function of a chunk and its input data returning its result
+    - write_func: function of a chunk and its result
+    '''
+    chunks = iter(chunks)
+    if not threads:
+        for chunk in chunks:
+            result = compute_func(chunk, read_func(chunk))
+            if write_func is not None:
+                write_func(chunk, result)
+        return
+
+    with ThreadPoolExecutor(max_workers=1, initializer=_init_thread) as reader, \
+            ThreadPoolExecutor(max_workers=1, initializer=_init_thread) as writer:
+        chunk = next(chunks, None)
+        if chunk is not None:
+            read_future = reader.submit(read_func, chunk)
+        write_future = None
+        while chunk is not None:
+            data = read_future.result()
+            next_chunk = next(chunks, None)
+            if next_chunk is not None:
+                read_future = reader.submit(read_func, next_chunk)
+            result = compute_func(chunk, data)
+            if write_future is not None:
+                write_future.result()
+            if write_func is not None:
+                write_future = writer.submit(write_func, chunk, result)
+            chunk = next_chunk
+        if write_future is not None:
+            write_future.result()
+
+def _read_ebf_block(infile, key, start, stop):
+    ''' Read rows [start, stop) of an ebf column '''
+    return start, stop, ebf.read(infile, f'/{key}', begin=start, end=stop)
+
+def ebf_to_hdf5(infile, outfile, keys, block_size=_DEFAULT_EBF_BLOCK_SIZE, workers=1):
     ''' Convert ebf file to hdf5 file
     Args:
     - outfile: [str] path to output hdf5 file
     - infile: [str] path to input ebf file
     - keys: [list, dict] list of keys to copy.
     If given dict, change key name from dict key to dict val
+    - block_size: [int] number of rows read at once per column
+    - workers: [int] number of worker processes reading the ebf file
+
+    Each column is read in blocks of rows and written into a preallocated
+    dataset, so the peak memory is bounded by 2 * workers * block_size rows.
+    Keys missing from the ebf file are filled with zeros.
     '''
     # Get the total number of samples
     if isinstance(keys, dict):
@@ -76,21 +469,131 @@ def ebf_to_hdf5(infile, outfile, keys):
     logger.info(f"Total number of samples: {num_samples}")
 
     # Open output file
-    with h5py.File(outfile, 'w') as f:
-        # Iterate over all keys
+    with h5py.File(outfile, 'a') as f:
+        # Preallocate all datasets
+        tasks = []
         for key in keys:
             if isinstance(keys, dict):
                 new_key = keys[key]
             else:
                 new_key = key
-            logger.info(f"Copying key {key} to {new_key}")
-
-            # Read data from file
-            try:
-                data = ebf.read(infile, f'/{key}')
-            except:
-                data = np.zeros(num_samples)
-            try:
-                append_dataset(f, new_key, data)
-            except Exception as e:
-                pass
+            if not ebf.containsKey(infile, f'/{key}'):
+                logger.warning(f"Key {key} does not exist. Fill {new_key} with zeros")
+                preallocate_dataset(f, new_key, num_samples, np.float64)
+                continue
+            dtype = ebf.getHeader(infile, f'/{key}').get_dtype()
+            preallocate_dataset(f, new_key, num_samples, dtype)
+            for start in range(0, num_samples, block_size):
+                stop = min(start + block_size, num_samples)
+                tasks.append((key, new_key, start, stop))
+
+        # Read blocks and write them as they are ready
+        logger.info(f"Copying {len(tasks)} blocks with {workers} workers")
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = deque()
+                for key, new_key, start, stop in tasks:
+                    futures.append((new_key, executor.submit(
+                        _read_ebf_block, infile, key, start, stop)))
+                    if len(futures) >= 2 * workers:
+                        new_key, future = futures.popleft()
+                        start, stop, data = future.result()
+                        f[new_key][start: stop] = data
+                while futures:
+                    new_key, future = futures.popleft()
+                    start, stop, data = future.result()
+                    f[new_key][start: stop] = data
+        else:
+            # copy all columns of a block of rows before the next block, so that
+            # each block is logged once
+            block_start = None
+            for key, new_key, start, stop in sorted(tasks, key=lambda task: task[2]):
+                if start != block_start:
+                    logger.info(f"Copying rows [{start}:{stop}]")
+                    block_start = start
+                logger.debug(f"Copying key {key} to {new_key} [{start}:{stop}]")
+                _, _, data = _read_ebf_block(infile, key, start, stop)
+                f[new_key][start: stop] = data
+
+def read_ebf_headers(infile):
+    ''' Read the headers of all data objects of an ebf file in a single scan.
+    Returns a dict of headers keyed by lower-case tag name '''
+    headers = {}
+    with open(infile, 'rb') as fp:
+        fp.seek(0, 2)
+        filesize = fp.tell()
+        fp.seek(0, 0)
+        while fp.tell() < filesize:
+            header = ebf._EbfHeader()
+            header.read(fp)
+            headers[ebf.tostr(header.name).lower()] = header
+            fp.seek(header.capacity(), 1)
+    return headers
+
+def ebf_memmap(infile, header):
+    ''' Return a zero-copy, read-only memory map of an ebf data object '''
+    dtype = header.get_dtype()
+    if header.flagswap == 1:
+        dtype = dtype.newbyteorder()
+    return np.memmap(
+        infile, dtype=dtype, mode='r', offset=header.datapos,
+        shape=tuple(header.getshape()))
+
+class EBFFile:
+    ''' Read-only view of the columns of one or more ebf files.
+
+    Each column is a memory map at its byte offset in the ebf file, so slicing
+    a row range reads only those rows. The object can be used in place of an
+    h5py.File opened in read mode by the pipelines.
+
+    Args:
+    - keys_by_file: [dict] dict of ebf file path to list or dict of keys.
+    If given dict, change key name from dict key to dict val
+    - start, stop: [int] row range of the view
+    '''
+    def __init__(self, keys_by_file, start=None, stop=None):
+        self._columns = {}
+        missing = []
+        for infile, keys in keys_by_file.items():
+            headers = read_ebf_headers(infile)
+            for key in keys:
+                new_key = keys[key] if isinstance(keys, dict) else key
+                header = headers.get(f'/{key}'.lower())
+                if header is None:
+                    logger.warning(f"Key {key} does not exist. Fill {new_key} with zeros")
+                    missing.append(new_key)
+                    continue
+                self._columns[new_key] = ebf_memmap(infile, header)
+
+        num_samples = len(next(iter(self._columns.values())))
+        for new_key in missing:
+            self._columns[new_key] = np.broadcast_to(np.float64(0), (num_samples, ))
+        self.start, self.stop, _ = slice(start, stop).indices(num_samples)
+        self.filenames = list(keys_by_file.keys())
+
+    def __getitem__(self, key):
+        return self._columns[key][self.start: self.stop]
+
+    def __contains__(self, key):
+        return key in self._columns
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def keys(self):
+        return self._columns.keys()
+
+    def items(self):
+        return ((key, self[key]) for key in self._columns)
+
+    def close(self):
+        self._columns = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,163 @@
+
+import logging
+
+import numpy as np
+
+from .logger import logger
+try:
+    import numba
+    # the root logger is at DEBUG level, which would log every compilation step
+    logging.getLogger('numba').setLevel(logging.WARNING)
+except ImportError:
+    # numba is optional, only --engine numba needs it
+    numba = None
+    logger.debug('Cannot import numba')
+
+# Implementations of the per-star arithmetic. The numba kernels compute each
+# group of quantities in a single multi-threaded pass over the rows, without
+# the full-length temporaries of the NumPy implementations. They agree with
+# NumPy up to rounding.
+_ENGINES = ('numpy', 'numba')
+_DEFAULT_ENGINE = 'numpy'
+
+def _check_engine(engine):
+    """ Check that an engine is known and available """
+    if engine not in _ENGINES:
+        raise ValueError(f'Unknown engine: {engine}')
+    if engine == 'numba' and numba is None:
+        raise ValueError('The numba engine requires numba to be installed')
+
+def _jit(parallel=False):
+    """ Compile a function with numba if it is installed. The compiled code is
+    cached on disk, so that each job does not compile the kernels again """
+    def decorator(func):
+        if numba is None:
+            return func
+        return numba.njit(parallel=parallel, cache=True)(func)
+    return decorator
+
+_prange = range if numba is None else numba.prange
+
+@_jit()
+def _extinct(mag_int, a_0, X, X2, a_02, coeff):
+    """ Extincted magnitude of a star, see extinction.app_to_ext """
+    k_mag = (coeff[0] + coeff[1] * X + coeff[2] * X2 + coeff[3] * X2 * X
+             + coeff[4] * a_0 + coeff[5] * a_02 + coeff[6] * a_02 * a_0
+             + coeff[7] * X * a_0 + coeff[8] * a_0 * X2 + coeff[9] * X * a_02)
+    return mag_int + k_mag * a_0
+
+@_jit(parallel=True)
+def _extinction_kernel(dmod, a_0, g_abs, bp_abs, rp_abs, logteff, coeffs,
+                       use_teff, extrapolate, X_min, X_max, out):
+    for i in _prange(len(dmod)):
+        if use_teff:
+            X = 10**logteff[i] / 5040
+        else:
+            X = bp_abs[i] - rp_abs[i]
+        # NaN stays NaN when extrapolating, like in NumPy
+        if extrapolate and X < X_min:
+            X = X_min
+        elif extrapolate and X > X_max:
+            X = X_max
+        outside = (X < X_min) or (X > X_max)
+        X2 = X * X
+        a_02 = a_0[i] * a_0[i]
+
+        g_int = g_abs[i] + dmod[i]
+        bp_int = bp_abs[i] + dmod[i]
+        rp_int = rp_abs[i] + dmod[i]
+        if outside:
+            g_true = bp_true = rp_true = np.nan
+        else:
+            g_true = _extinct(g_int, a_0[i], X, X2, a_02, coeffs[0])
+            bp_true = _extinct(bp_int, a_0[i], X, X2, a_02, coeffs[1])
+            rp_true = _extinct(rp_int, a_0[i], X, X2, a_02, coeffs[2])
+
+        out[0, i] = g_int
+        out[1, i] = g_true
+        out[2, i] = bp_int
+        out[3, i] = bp_true
+        out[4, i] = rp_int
+        out[5, i] = rp_true
+        out[6, i] = g_true - g_int
+        out[7, i] = (bp_true - bp_int) - (rp_true - rp_int)
+        out[8, i] = bp_true - rp_true
+        out[9, i] = bp_true - g_true
+        out[10, i] = g_true - rp_true
+
+# Output columns of calc_extinction, in the order of the rows of the kernel output
+_EXTINCTION_KEYS = (
+    'phot_g_mean_mag_int', 'phot_g_mean_mag_true',
+    'phot_bp_mean_mag_int', 'phot_bp_mean_mag_true',
+    'phot_rp_mean_mag_int', 'phot_rp_mean_mag_true',
+    'a_g_val', 'e_bp_min_rp_val', 'bp_rp_true', 'bp_g_true', 'g_rp_true',
+)
+
+def calc_extinction(dmod, a_0, g_abs, bp_abs, rp_abs, logteff, coeffs,
+                    ext_var='bminr', extrapolate=True, X_range=(-0.06, 2.5)):
+    """ Calculate the G, BP and RP extincted magnitudes and the extinction and
+    colors of extinction.calc_extinction in a single pass
+
+    Args:
+    - coeffs: [array] (3, 10) coefficients of the extinction law of G, BP and RP
+    - X_range: [tuple] range of the variable of the extinction law
+    """
+    out = np.empty((len(_EXTINCTION_KEYS), len(dmod)))
+    _extinction_kernel(
+        dmod, a_0, g_abs, bp_abs, rp_abs, logteff, np.asarray(coeffs, dtype=np.float64),
+        ext_var == 'logteff', extrapolate, X_range[0], X_range[1], out)
+    return dict(zip(_EXTINCTION_KEYS, out))
+
+@_jit()
+def _gminr_to_grvsminr(gminr, extrapolate):
+    """ G_RVS-G_RP of a star, see photometric_utils.gminr_to_grvsminr """
+    if extrapolate and gminr < -0.15:
+        gminr = -0.15
+    elif extrapolate and gminr > 1.7:
+        gminr = 1.7
+    if -0.15 < gminr < 1.2:
+        return -0.0397 - 0.2852 * gminr - 0.0330 * gminr**2 - 0.0867 * gminr**3
+    if 1.2 < gminr < 1.7:
+        return -4.0618 + 10.0187 * gminr - 9.0532 * gminr**2 + 2.6089 * gminr**3
+    return np.nan
+
+@_jit(parallel=True)
+def _rv_uncertainties_kernel(g_mag, rp_mag, logteff, extrapolate, rv_error, rv_error_corr):
+    for i in _prange(len(g_mag)):
+        grvs = _gminr_to_grvsminr(g_mag[i] - rp_mag[i], extrapolate) + rp_mag[i]
+        if 10**logteff[i] < 6750:
+            rv_error[i] = 0.12 + 6.0 * np.exp(0.9 * (grvs - 14.0))
+        else:
+            rv_error[i] = 0.4 + 20.0 * np.exp(0.8 * (grvs - 12.75))
+        if grvs < 8.0:
+            grvs = 8.0
+        if grvs > 12.0:
+            rv_error_corr[i] = 16.554 - 2.4899 * grvs + 0.09933 * grvs**2
+        else:
+            rv_error_corr[i] = 0.318 + 0.3884 * grvs - 0.02778 * grvs**2
+
+def rv_uncertainties(g_mag, rp_mag, logteff, extrapolate=False):
+    """ Calculate G_RVS from G and G_RP, and the RV errors and error correction
+    factor of spectroscopic.rv_uncertainties from it in a single pass """
+    rv_error = np.empty(len(g_mag))
+    rv_error_corr = np.empty(len(g_mag))
+    _rv_uncertainties_kernel(g_mag, rp_mag, logteff, extrapolate, rv_error, rv_error_corr)
+    return rv_error, rv_error_corr
+
+@_jit(parallel=True)
+def _rvs_select_kernel(g_mag, rp_mag, logteff, extrapolate, select):
+    for i in _prange(len(g_mag)):
+        grvs = _gminr_to_grvsminr(g_mag[i] - rp_mag[i], extrapolate) + rp_mag[i]
+        teff = 10**logteff[i]
+        if grvs <= 12:
+            select[i] = (3600 < teff) and (teff < 14500)
+        elif grvs < 14:
+            select[i] = (3100 < teff) and (teff < 6750)
+        else:
+            select[i] = False
+
+def calc_rvs_select(g_mag, rp_mag, logteff, extrapolate=True):
+    """ Calculate the RVS selection mask of selection.calc_rvs_select in a single pass """
+    select = np.empty(len(g_mag), dtype=np.bool_)
+    _rvs_select_kernel(g_mag, rp_mag, logteff, extrapolate, select)
+    return select
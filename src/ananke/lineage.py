@@ -0,0 +1,118 @@
+
+import hashlib
+import json
+import os
+import time
+
+import h5py
+
+# Prefix of the file attribute that stores the lineage record of a stage
+_ATTR_PREFIX = 'lineage:'
+
+# Number of bytes hashed at the start and at the end of the files that are not
+# produced by the pipeline, e.g. the headers of the Galaxia EBF files
+_FINGERPRINT_SAMPLE_SIZE = 1048576
+
+def read_record(path, stage):
+    """ Read the lineage record of a stage from an hdf5 file.
+    Returns None if the file or the record does not exist """
+    if not os.path.exists(path) or not h5py.is_hdf5(path):
+        return None
+    with h5py.File(path, 'r') as f:
+        record = f.attrs.get(_ATTR_PREFIX + stage)
+    if record is None:
+        return None
+    return json.loads(record)
+
+def write_record(path, stage, record, columns):
+    """ Write the lineage record and the produced columns of a stage.
+
+    The record also stores the time of the run, so that the fingerprint of the
+    output changes whenever it is rewritten, e.g. when a stage is forced.
+    """
+    record = dict(record, columns=sorted(columns), time=time.time())
+    with h5py.File(path, 'a') as f:
+        f.attrs[_ATTR_PREFIX + stage] = json.dumps(record, sort_keys=True)
+
+def fingerprint(path, upstream=None):
+    """ Fingerprint of an input file.
+
+    If the file was produced by an upstream stage, this is the hash of the
+    lineage record of that stage, so it only changes when the content does.
+    Otherwise, e.g. for the Galaxia EBF files, this is the hash of the size and
+    of the first and last bytes of the file, which hold the headers. Unlike the
+    modification time, it does not change when the file is copied.
+    """
+    if upstream is not None:
+        record = read_record(path, upstream)
+        if record is not None:
+            record = json.dumps(record, sort_keys=True)
+            return hashlib.sha256(record.encode()).hexdigest()
+    if not os.path.exists(path):
+        return None
+    size = os.path.getsize(path)
+    digest = hashlib.sha256(str(size).encode())
+    with open(path, 'rb') as f:
+        digest.update(f.read(_FINGERPRINT_SAMPLE_SIZE))
+        f.seek(max(size - _FINGERPRINT_SAMPLE_SIZE, 0))
+        digest.update(f.read())
+    return digest.hexdigest()
+
+def relative_path(path, basedirs):
+    """ Return a path relative to the first of `basedirs` that contains it, or
+    the path itself if none does """
+    path = os.path.abspath(path)
+    for basedir in basedirs:
+        basedir = os.path.abspath(basedir)
+        if os.path.commonpath([path, basedir]) == basedir:
+            return os.path.relpath(path, basedir)
+    return path
+
+def make_record(stage, version, FLAGS, flag_keys, inputs, basedirs=()):
+    """ Create the lineage record of a stage.
+
+    The inputs are keyed by their path relative to `basedirs`, so that the
+    record does not change when the data is moved to another directory.
+
+    Args:
+    - stage: [str] name of the stage
+    - version: [int] version of the stage, bumped whenever its output changes
+    - FLAGS: command line arguments
+    - flag_keys: [list] names of the arguments that change the output of the stage
+    - inputs: [list] list of (path, upstream stage) of the input files.
+    The upstream stage is None for files that are not produced by the pipeline.
+    - basedirs: [list] base directories of the input files
+    """
+    return {
+        'stage': stage,
+        'version': version,
+        'flags': {key: getattr(FLAGS, key) for key in flag_keys},
+        'inputs': {
+            relative_path(path, basedirs): fingerprint(path, upstream)
+            for path, upstream in inputs},
+    }
+
+def is_up_to_date(path, stage, record):
+    """ Check if the stored lineage record of a stage matches the given record """
+    stored = read_record(path, stage)
+    if stored is None:
+        return False
+    stored.pop('columns', None)
+    stored.pop('time', None)
+    # round-trip through JSON to compare the same types
+    return stored == json.loads(json.dumps(record))
+
+def inputs_match(path, stage, record):
+    """ Check if the inputs of the stored lineage record of a stage match those
+    of the given record, whatever its arguments """
+    stored = read_record(path, stage)
+    if stored is None:
+        return False
+    return stored['inputs'] == json.loads(json.dumps(record['inputs']))
+
+def get_columns(path):
+    """ Return the set of columns of an hdf5 file, or an empty set if it does not exist """
+    if not os.path.exists(path):
+        return set()
+    with h5py.File(path, 'r') as f:
+        return set(f.keys())
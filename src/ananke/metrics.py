@@ -0,0 +1,197 @@
+
+import json
+import os
+import resource
+import socket
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+# Recorder of the running stage, or None if no metrics are recorded
+_RECORDER = None
+
+# I/O counters of /proc/self/io. The bytes read and written by the process,
+# including from the page cache and pipes, and the bytes fetched from and
+# sent to the storage layer.
+_IO_KEYS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+
+def read_io_counters():
+    """ Read the I/O counters of the process. Returns an empty dict if they are
+    not available, e.g. on macOS """
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f)
+    except OSError:
+        return {}
+    return {key: int(counters[key]) for key in _IO_KEYS if key in counters}
+
+def reset_peak_rss():
+    """ Reset the peak resident set size of the process to the current one.
+    Returns False if this is not supported """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def read_peak_rss():
+    """ Return the peak resident set size in bytes since the last reset.
+    Fall back to the peak since the start of the process """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def read_rss():
+    """ Return the current resident set size in bytes. Fall back to the peak
+    since the last reset if it is not available """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return read_peak_rss()
+
+def _to_builtin(val):
+    """ Convert NumPy scalars for JSON """
+    if isinstance(val, np.generic):
+        return val.item()
+    raise TypeError(f"Object of type {type(val).__name__} is not JSON serializable")
+
+class _Counters:
+    """ Snapshot of the time and I/O counters of the process """
+    def __init__(self):
+        self.wall_time = time.time()
+        self.cpu_time = time.process_time()
+        times = os.times()
+        self.children_cpu_time = times.children_user + times.children_system
+        self.io = read_io_counters()
+
+    def since(self, start):
+        """ Return the metrics between a previous snapshot and this one """
+        metrics = {
+            'wall_time': self.wall_time - start.wall_time,
+            'cpu_time': self.cpu_time - start.cpu_time,
+            'children_cpu_time': self.children_cpu_time - start.children_cpu_time,
+        }
+        for key in self.io.keys() & start.io.keys():
+            metrics[key] = self.io[key] - start.io[key]
+        return metrics
+
+class MetricsRecorder:
+    """ Record the performance metrics of a stage and its batches as JSON lines
+
+    Each line is a record with the wall and CPU time, the I/O counters and the
+    peak resident set size of the process since the previous batch (type
+    'batch') or since the start of the stage (type 'stage'). CPU time of worker
+    processes is only counted in `children_cpu_time` of the stage once the
+    workers exit.
+    """
+    def __init__(self, path, stage, **context):
+        self.path = path
+        self.stage = stage
+        self.context = context
+        self.rows_in = None
+        self.rows_out = None
+        self.num_batches = 0
+        self.peak_rss = 0
+        self.status = 'done'
+        self.batch_callbacks = []
+        self._batch_peak_rss = 0
+        reset_peak_rss()
+        self._stage_start = self._batch_start = _Counters()
+        self._start_time = self._stage_start.wall_time
+
+    def write(self, record):
+        """ Append a record to the metrics file """
+        record = dict(self.context, stage=self.stage, **record)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, default=_to_builtin) + '\n')
+
+    def _peak_rss(self):
+        """ Return the peak RSS since the last call and keep track of the peak of the stage """
+        peak_rss = max(read_peak_rss(), self._batch_peak_rss)
+        self.peak_rss = max(self.peak_rss, peak_rss)
+        self._batch_peak_rss = 0
+        reset_peak_rss()
+        return peak_rss
+
+    def reset_peak_rss(self):
+        """ Reset the peak RSS within a batch, keeping track of the peak of the batch """
+        self._batch_peak_rss = max(self._batch_peak_rss, read_peak_rss())
+        reset_peak_rss()
+
+    def record_batch(self, rows_in=None, rows_out=None, **info):
+        """ Record the metrics since the previous batch """
+        now = _Counters()
+        self.write(dict(
+            type='batch', rows_in=rows_in, rows_out=rows_out, **info,
+            **now.since(self._batch_start), peak_rss=self._peak_rss()))
+        self._batch_start = now
+        self.num_batches += 1
+        for callback in self.batch_callbacks:
+            callback(rows_in=rows_in, rows_out=rows_out, **info)
+
+    def record_rows(self, rows_in, rows_out):
+        """ Set the number of input and output rows of the stage """
+        self.rows_in = rows_in
+        self.rows_out = rows_out
+
+    def close(self):
+        """ Record the metrics of the whole stage """
+        now = _Counters()
+        self.write(dict(
+            type='stage', status=self.status, start_time=self._start_time,
+            rows_in=self.rows_in, rows_out=self.rows_out, num_batches=self.num_batches,
+            **now.since(self._stage_start), peak_rss=max(self._peak_rss(), self.peak_rss)))
+
+@contextmanager
+def record_stage(path, stage, **context):
+    """ Record the metrics of a stage, and of its batches that call
+    `record_batch`, to a JSON lines file. The context, e.g. the galaxy, LSR,
+    rslice and job index, is added to every record. """
+    global _RECORDER
+    recorder = MetricsRecorder(path, stage, host=socket.gethostname(), **context)
+    _RECORDER = recorder
+    try:
+        yield recorder
+    except BaseException:
+        recorder.status = 'failed'
+        raise
+    finally:
+        _RECORDER = None
+        recorder.close()
+
+def record_batch(rows_in=None, rows_out=None, **info):
+    """ Record the metrics of a batch of the running stage, if any """
+    if _RECORDER is not None:
+        _RECORDER.record_batch(rows_in=rows_in, rows_out=rows_out, **info)
+
+def reset_batch_peak_rss():
+    """ Reset the peak resident set size, e.g. after measuring one part of a
+    batch. The recorded peak of the batch and of the stage, if any, still
+    include the peak before the reset """
+    if _RECORDER is not None:
+        _RECORDER.reset_peak_rss()
+    else:
+        reset_peak_rss()
+
+def record_rows(rows_in, rows_out):
+    """ Set the number of input and output rows of the running stage, if any """
+    if _RECORDER is not None:
+        _RECORDER.record_rows(rows_in, rows_out)
+
+def add_batch_callback(callback):
+    """ Call a function with the batch information at the end of every batch
+    of the running stage, if any """
+    if _RECORDER is not None:
+        _RECORDER.batch_callbacks.append(callback)
@@ -1,20 +1,38 @@
-
 import numpy as np
-from scipy.interpolate import interp1d
+
+# Range and number of grid points of the V-I grid of the inverse of vmini_to_bminr
+_VMINI_RANGE = (-0.4, 5)
+_VMINI_GRID_NUM = 10000
+
+# Registry of the inverse tables of vmini_to_bminr, keyed by range and number of points
+_VMINI_TABLES = {}
+
+def get_vmini_table(vmini_range=_VMINI_RANGE, num=_VMINI_GRID_NUM):
+    ''' Return the cached inverse table of vmini_to_bminr, initializing it on first use
+
+    Returns:
+    - bminr_grid: [array] G_BP-G_RP on the V-I grid, in increasing order
+    - vmini_grid: [array] V-I grid
+    - bounds: [array] midpoints of the intervals of the grid
+    '''
+    key = (vmini_range, num)
+    if key not in _VMINI_TABLES:
+        vmini_grid = np.linspace(*vmini_range, num)
+        bminr_grid = vmini_to_bminr(vmini_grid)
+        bounds = (bminr_grid[1:] + bminr_grid[:-1]) / 2.0
+        _VMINI_TABLES[key] = (bminr_grid, vmini_grid, bounds)
+    return _VMINI_TABLES[key]
 
 def bminr_to_vmini(bminr, extrapolate=False):
-    ''' Convert Gaia G_BP-G_RP to V-I '''
-    vmini_max = 5
-    vmini_min = -0.4
-    vmini = np.linspace(vmini_min, vmini_max, 10000)
+    ''' Convert Gaia G_BP-G_RP to V-I
 
+    Linearly interpolate the inverse table of vmini_to_bminr, with NaN outside
+    of the table. If extrapolate, take the nearest point of the table instead.
+    '''
+    bminr_grid, vmini_grid, bounds = get_vmini_table()
     if extrapolate:
-        return interp1d(
-            vmini_to_bminr(vmini), vmini, kind='nearest',
-            fill_value='extrapolate', bounds_error=False)(bminr)
-    else:
-        return interp1d(
-            vmini_to_bminr(vmini), vmini, bounds_error=False)(bminr)
+        return vmini_grid[np.searchsorted(bounds, bminr, side='left')]
+    return np.interp(bminr, bminr_grid, vmini_grid, left=np.nan, right=np.nan)
 
 def vmini_to_bminr(vmini, extrapolate=False):
     ''' Convert V-I to Gaia G_BP-G_RP '''
@@ -47,17 +65,19 @@ def gminr_to_grvsminr(gminr, extrapolate=False):
             gminr[gminr < gminr_min] = gminr_min
             gminr[gminr > gminr_max] = gminr_max
 
-    res = np.empty_like(gminr)*np.nan
-    # Case 1
-    mask = ((gminr > gminr_min) & (gminr < gminr_mid))
-    res[mask] = (
-        - 0.0397 - 0.2852 * gminr[mask]
-        - 0.0330 * gminr[mask]**2 - 0.0867 * gminr[mask]**3)
-    # Case 2
-    mask = ((gminr > gminr_mid) & (gminr < gminr_max))
-    res[mask] = (
-        - 4.0618 + 10.0187 * gminr[mask]
-        - 9.0532 * gminr[mask]**2 + 2.6089 * gminr[mask]**3)
-    return res
-
+    # Evaluate both cases on all stars instead of on masked copies. The bounds
+    # are excluded, so G-G_RP at a bound, e.g. after extrapolating, gives NaN
+    gminr2 = gminr**2
+    gminr3 = gminr**3
+    with np.errstate(invalid='ignore'):
+        # Case 1
+        res = np.where(
+            (gminr > gminr_min) & (gminr < gminr_mid),
+            - 0.0397 - 0.2852 * gminr - 0.0330 * gminr2 - 0.0867 * gminr3,
+            np.nan)
+        # Case 2
+        return np.where(
+            (gminr > gminr_mid) & (gminr < gminr_max),
+            - 4.0618 + 10.0187 * gminr - 9.0532 * gminr2 + 2.6089 * gminr3,
+            res)
 
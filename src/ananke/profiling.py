@@ -0,0 +1,104 @@
+
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+from . import io, metrics
+
+# Number of functions listed in each table of the hot-spot summary
+_NUM_SUMMARY_LINES = 40
+
+# Number of functions listed for each batch of the hot-spot summary
+_NUM_BATCH_SUMMARY_LINES = 10
+
+class StageProfiler:
+    """ Profile a stage with cProfile
+
+    The profile of the whole stage is dumped to `{prefix}.prof`, and a text
+    summary of its hot spots is written to `{prefix}.prof.txt`. If `per_batch`
+    is set, the profile is also split at the end of every batch recorded with
+    `metrics.record_batch`, and the summary has a numbered section with the hot
+    spots of each batch.
+
+    cProfile only profiles the thread that enables it, so the reader and writer
+    threads of `io.process_chunks`, which do the hdf5 reads and writes, are
+    profiled separately. Their profiles are added to the profile of the stage,
+    but not to the sections of the batches.
+    """
+    def __init__(self, prefix, per_batch=False):
+        self.prefix = prefix
+        self.path = f'{prefix}.prof'
+        self.per_batch = per_batch
+        self.batches = []
+        self._profile = None
+        self._thread_profiles = []
+
+    def start(self):
+        """ Start a new profile """
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def start_thread(self):
+        """ Profile the calling thread until it exits """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # since Python 3.12 the profile of the stage covers all threads, and
+            # a second profile cannot be enabled
+            return
+        self._thread_profiles.append(profile)
+
+    def _snapshot(self):
+        """ Stop the current profile and return its statistics """
+        self._profile.disable()
+        return pstats.Stats(self._profile)
+
+    def next_batch(self, **info):
+        """ Keep the profile of the batch that just finished and start the next one """
+        if self.per_batch:
+            label = ', '.join(f'{key}={val}' for key, val in info.items())
+            self.batches.append((f'Batch {len(self.batches)}: {label}', self._snapshot()))
+            self.start()
+
+    def stop(self):
+        """ Write the profile and the summary of the stage. The reader and
+        writer threads have exited at the end of `io.process_chunks` """
+        stats = self._snapshot()
+        if self.per_batch:
+            self.batches.append(('After the last batch', stats))
+            stats = pstats.Stats()
+            for _, batch_stats in self.batches:
+                stats.add(batch_stats)
+        for profile in self._thread_profiles:
+            stats.add(profile)
+        stats.dump_stats(self.path)
+        write_summary(stats, f'{self.prefix}.prof.txt', self.batches)
+
+def write_summary(stats, out_path, batches=(), num_lines=_NUM_SUMMARY_LINES,
+                  num_batch_lines=_NUM_BATCH_SUMMARY_LINES):
+    """ Write the functions with the largest cumulative and internal time of a
+    profile to a text file, followed by those with the largest cumulative time
+    of each of the (label, stats) of `batches` """
+    with open(out_path, 'w') as f:
+        stats.stream = f
+        for sort_key in ('cumulative', 'tottime'):
+            f.write(f'Sorted by {sort_key} time\n')
+            stats.sort_stats(sort_key).print_stats(num_lines)
+        for label, batch_stats in batches:
+            f.write(f'{label}\n')
+            batch_stats.stream = f
+            batch_stats.sort_stats('cumulative').print_stats(num_batch_lines)
+
+@contextmanager
+def profile_stage(prefix, per_batch=False):
+    """ Profile the code in the context, see `StageProfiler` """
+    profiler = StageProfiler(prefix, per_batch=per_batch)
+    metrics.add_batch_callback(profiler.next_batch)
+    io.add_thread_initializer(profiler.start_thread)
+    profiler.start()
+    try:
+        yield profiler
+    finally:
+        io.remove_thread_initializer(profiler.start_thread)
+        profiler.stop()
@@ -0,0 +1,80 @@
+
+import hashlib
+
+import numpy as np
+
+_DEFAULT_SEED = 0
+
+# Number of rows whose random integers are generated at once, to bound the
+# temporary arrays of a draw
+_BLOCK_SIZE = 65536
+
+class ChunkRNG:
+    """ Counter-based random number generator for a chunk of an rslice
+
+    Each (seed, gal, lsr, rslice, column) defines an independent Philox stream
+    whose counter is the global row index of the rslice. Row i of a column
+    always uses counter i, so the random numbers do not depend on the batch
+    size, the order in which chunks are processed, or the Njob split.
+    """
+    def __init__(self, gal, lsr, rslice, offset=0, seed=_DEFAULT_SEED):
+        self.gal = gal
+        self.lsr = lsr
+        self.rslice = rslice
+        self.offset = int(offset)
+        self.seed = seed
+
+    def at(self, offset):
+        """ Return a generator for the chunk starting at a global row offset """
+        return ChunkRNG(self.gal, self.lsr, self.rslice, offset, self.seed)
+
+    def key(self, column):
+        """ Return the 128-bit Philox key of a column """
+        name = f'{self.seed}/{self.gal}/{self.lsr}/{self.rslice}/{column}'
+        digest = hashlib.sha256(name.encode()).digest()
+        return np.frombuffer(digest[:16], dtype=np.uint64)
+
+    def iter_uniform_pairs(self, column, size):
+        """ Iterate over blocks of rows as (start, stop, u1, u2), with u1 and u2
+        uniform numbers in (0, 1] and [0, 1) of the rows of the block """
+        bit_generator = np.random.Philox(key=self.key(column))
+        bit_generator.advance(self.offset)
+        for start in range(0, size, _BLOCK_SIZE):
+            stop = min(start + _BLOCK_SIZE, size)
+            # each counter step produces 4 random 64-bit integers, use the first 2
+            raw = bit_generator.random_raw(4 * (stop - start)).reshape(stop - start, 4)
+            u1 = ((raw[:, 0] >> np.uint64(11)) + 1) * 2.**-53
+            u2 = (raw[:, 1] >> np.uint64(11)) * 2.**-53
+            yield start, stop, u1, u2
+
+    def uniform_pair(self, column, size):
+        """ Return two arrays of uniform numbers in (0, 1] and [0, 1) """
+        u1 = np.empty(size)
+        u2 = np.empty(size)
+        for start, stop, u1_block, u2_block in self.iter_uniform_pairs(column, size):
+            u1[start: stop] = u1_block
+            u2[start: stop] = u2_block
+        return u1, u2
+
+    def standard_normal(self, column, size):
+        """ Draw standard normal numbers with the Box-Muller transform """
+        out = np.empty(size)
+        for start, stop, u1, u2 in self.iter_uniform_pairs(column, size):
+            out[start: stop] = np.sqrt(-2 * np.log(u1)) * np.cos(2 * np.pi * u2)
+        return out
+
+    def normal(self, loc, scale, column):
+        """ Draw normal numbers for the rows of the chunk """
+        loc = np.asarray(loc)
+        return loc + scale * self.standard_normal(column, len(loc))
+
+class GlobalRNG:
+    """ Draw from the global NumPy random state (legacy behavior) """
+    def normal(self, loc, scale, column):
+        return np.random.normal(loc, scale)
+
+_GLOBAL_RNG = GlobalRNG()
+
+def get_rng(rng=None):
+    """ Return the given generator or fall back to the global NumPy random state """
+    return _GLOBAL_RNG if rng is None else rng
@@ -1,12 +1,13 @@
 
 import numpy as np
-from . import photometric_utils
+from . import photometric_utils, kernels
 
-def calc_general_select(data):
-    A0 = data['A0'][:]
-    G = data['phot_g_mean_mag'][:]
-    BP = data['phot_bp_mean_mag'][:]
-    RP = data['phot_rp_mean_mag'][:]
+def calc_general_select(data, indices=(None, None)):
+    i_start, i_stop = indices
+    A0 = data['A0'][i_start: i_stop]
+    G = data['phot_g_mean_mag'][i_start: i_stop]
+    BP = data['phot_bp_mean_mag'][i_start: i_stop]
+    RP = data['phot_rp_mean_mag'][i_start: i_stop]
 
     select = (
         (A0 <= 20)
@@ -15,10 +16,16 @@ def calc_general_select(data):
     )
     return select
 
-def calc_rvs_select(data, extrapolate=True):
-    G = data['phot_g_mean_mag'][:]
-    RP = data['phot_rp_mean_mag'][:]
-    Teff = 10**data['logteff'][:]
+def calc_rvs_select(data, extrapolate=True, indices=(None, None),
+                    engine=kernels._DEFAULT_ENGINE):
+    kernels._check_engine(engine)
+    i_start, i_stop = indices
+    G = data['phot_g_mean_mag'][i_start: i_stop]
+    RP = data['phot_rp_mean_mag'][i_start: i_stop]
+    if engine == 'numba':
+        return kernels.calc_rvs_select(
+            G, RP, data['logteff'][i_start: i_stop], extrapolate=extrapolate)
+    Teff = 10**data['logteff'][i_start: i_stop]
     Grvs = photometric_utils.gminr_to_grvsminr(
         G - RP, extrapolate=extrapolate) + RP
 
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+import pytest
+
+from ananke import config
+from ananke.benchmarks import synthetic
+from ananke.bin import calc_props
+
+def make_flags(**kwargs):
+    flags = dict(
+        gal='m12i', lsr=0, rslice=0, ijob=0, Njob=1, ext_var='bminr', ext_extrapolate=False,
+        err_extrapolate=False, seed=0, batch_size=300, workers=1, memory_budget=None,
+        recompute=None, engine='numpy')
+    flags.update(kwargs)
+    return SimpleNamespace(**flags)
+
+def write_input(basedir):
+    """ Write a synthetic gmag_cut output and return its path """
+    path = basedir / 'm12i/lsr-0' / 'lsr-0-rslice-0.m12i-res7100-md-sliced-gcat-dr3.0.hdf5'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, 'w') as f:
+        for key, val in synthetic.make_batch(2000, np.random.default_rng(0)).items():
+            f.create_dataset(key, data=val, maxshape=(None, ))
+        f.attrs['row_offset'] = 100
+    return path
+
+def read(path):
+    with h5py.File(path, 'r') as f:
+        return {key: f[key][:] for key in f}
+
+def test_checkpoint_resume(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'DR3_PRESF_BASEDIR', str(tmp_path))
+    path = write_input(tmp_path)
+    calc_props.main(make_flags())
+    expected = read(path)
+
+    # interrupt the run after a few batches, then resume it
+    path = write_input(tmp_path)
+    calc_batch_worker = calc_props._calc_batch_worker
+    num_calls = 0
+
+    def interrupted_worker(*args, **kwargs):
+        nonlocal num_calls
+        num_calls += 1
+        if num_calls > 3:
+            raise KeyboardInterrupt
+        return calc_batch_worker(*args, **kwargs)
+
+    monkeypatch.setattr(calc_props, '_calc_batch_worker', interrupted_worker)
+    with pytest.raises(KeyboardInterrupt):
+        calc_props.main(make_flags())
+    monkeypatch.setattr(calc_props, '_calc_batch_worker', calc_batch_worker)
+    with h5py.File(path, 'r') as f:
+        assert 0 < f.attrs['calc_props_rows_done'] < 2000
+
+    calc_props.main(make_flags())
+    result = read(path)
+    assert set(result) == set(expected)
+    for key, val in expected.items():
+        np.testing.assert_array_equal(result[key], val, err_msg=key)
@@ -0,0 +1,30 @@
+import numpy as np
+
+from ananke import coordinates
+from ananke.benchmarks import synthetic
+
+def test_calc_coords_numpy_vs_astropy():
+    data = synthetic.make_batch(2000, np.random.default_rng(0))
+    expected = coordinates.calc_coords(data, engine='astropy')
+    result = coordinates.calc_coords(data)
+    assert set(result) == set(expected)
+    for key, val in expected.items():
+        np.testing.assert_allclose(result[key], val, rtol=1e-9, atol=1e-12, err_msg=key)
+
+def test_icrs_to_gal_numpy_vs_astropy():
+    rng = np.random.default_rng(0)
+    num = 2000
+    data = {
+        'ra': rng.uniform(0, 360, num),
+        'dec': np.rad2deg(np.arcsin(rng.uniform(-1, 1, num))),
+        'pmra': rng.normal(0, 5, num),
+        'pmdec': rng.normal(0, 5, num),
+    }
+    expected = coordinates.icrs_to_gal(data, engine='astropy')
+    result = coordinates.icrs_to_gal(data)
+    assert set(result) == set(expected)
+    for key, val in expected.items():
+        diff = np.abs(result[key] - val)
+        if key == 'l':
+            diff = np.minimum(diff, 360 - diff)
+        assert diff.max() < 1e-9, key
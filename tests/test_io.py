@@ -0,0 +1,76 @@
+import h5py
+import numpy as np
+import pytest
+
+from ananke import io
+
+def write_job(basedir, ijob, data):
+    """ Write a per-job rslice file of m12i, lsr 0, rslice 0 """
+    path = basedir / 'm12i/lsr-0' / f'lsr-0-rslice-0.m12i-res7100-md-sliced-gcat-dr3.{ijob}.hdf5'
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(path, 'w') as f:
+        for key, val in data.items():
+            f.create_dataset(key, data=val)
+        # data after the datasets, which a raw read of the wrong size would pick up
+        f.create_dataset('z_padding', data=np.full(100, -1.))
+
+def test_read_rslice_mixed_dtypes(tmp_path):
+    a0 = np.arange(5, dtype=np.float64)
+    a1 = np.arange(5, 12, dtype=np.float32)
+    b0 = np.arange(5, dtype=np.int32)
+    b1 = np.arange(5, 12, dtype=np.int64)
+    write_job(tmp_path, 0, {'a': a0, 'b': b0})
+    write_job(tmp_path, 1, {'a': a1, 'b': b1})
+
+    data = io.read_rslice(['a', 'b'], 'm12i', 0, 0, str(tmp_path), ijobs=[0, 1])
+    for key, vals in (('a', (a0, a1)), ('b', (b0, b1))):
+        expected = np.concatenate(vals)
+        assert data[key].dtype == expected.dtype
+        np.testing.assert_array_equal(data[key], expected)
+
+def test_catalog_no_files(tmp_path):
+    with pytest.raises(FileNotFoundError, match='rslice-0'):
+        io.Catalog.from_rslice('m12i', 0, 0, str(tmp_path))
+
+    write_job(tmp_path, 0, {'a': np.arange(5.)})
+    with pytest.raises(FileNotFoundError, match=r'\[1\]'):
+        io.Catalog.from_galaxy('m12i', 0, str(tmp_path), rslices=[1])
+    assert len(io.Catalog.from_galaxy('m12i', 0, str(tmp_path)).paths) == 1
+
+    with pytest.raises(ValueError):
+        io.Catalog([]).read()
+
+def test_catalog_predicate_pushdown(tmp_path, monkeypatch):
+    rng = np.random.default_rng(0)
+    jobs = [{key: rng.normal(size=num) for key in ('a', 'b', 'c')} for num in (25, 17)]
+    for ijob, data in enumerate(jobs):
+        write_job(tmp_path, ijob, data)
+
+    # column a of the rows with b > 0.5, in job order
+    expected = np.concatenate([data['a'][data['b'] > 0.5] for data in jobs])
+
+    catalog = io.Catalog.from_rslice('m12i', 0, 0, str(tmp_path), chunk_size=4)
+    catalog = catalog.select('a').where(lambda d: d['b'] > 0.5, 'b')
+    assert catalog.count() == len(expected)
+
+    # the column of the predicate is read for every chunk, but the selected
+    # column only for the chunks with rows passing the predicate
+    read_keys = []
+    getitem = h5py.Dataset.__getitem__
+
+    def spy_getitem(self, args):
+        read_keys.append(self.name.lstrip('/'))
+        return getitem(self, args)
+
+    monkeypatch.setattr(h5py.Dataset, '__getitem__', spy_getitem)
+    data = catalog.read()
+    assert set(data) == {'a'}
+    np.testing.assert_array_equal(data['a'], expected)
+    assert 'c' not in read_keys
+    num_chunks = sum((len(data['b']) + 3) // 4 for data in jobs)
+    num_chunks_select = sum(
+        (data['b'][i: i + 4] > 0.5).any()
+        for data in jobs for i in range(0, len(data['b']), 4))
+    assert num_chunks_select < num_chunks
+    assert read_keys.count('b') == num_chunks
+    assert read_keys.count('a') == num_chunks_select
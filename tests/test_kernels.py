@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from ananke import errors, extinction, io, kernels, selection
+from ananke.benchmarks import synthetic
+from ananke.bin import calc_props
+from ananke.rng import ChunkRNG
+
+pytestmark = pytest.mark.skipif(kernels.numba is None, reason='numba is not installed')
+
+@pytest.fixture(scope='module')
+def data():
+    """ Synthetic batch with the columns of calc_props """
+    data = io.ColumnCache(synthetic.make_batch(5000, np.random.default_rng(0)))
+    calc_props.calc_batch(data)
+    data = dict(data)
+    # missing temperatures and extinctions give NaN
+    data['logteff'][:10] = np.nan
+    data['A0'][10:20] = np.nan
+    return data
+
+def assert_close(result, expected):
+    assert set(result) == set(expected)
+    for key, val in expected.items():
+        np.testing.assert_allclose(result[key], val, rtol=1e-9, atol=1e-12, err_msg=key)
+
+@pytest.mark.parametrize('ext_var', ['bminr', 'logteff'])
+@pytest.mark.parametrize('extrapolate', [False, True])
+def test_extinction(data, ext_var, extrapolate):
+    kwargs = dict(ext_var=ext_var, extrapolate=extrapolate)
+    assert_close(
+        extinction.calc_extinction(data, engine='numba', **kwargs),
+        extinction.calc_extinction(data, **kwargs))
+
+@pytest.mark.parametrize('extrapolate', [False, True])
+def test_errors(data, extrapolate):
+    chunk_rng = ChunkRNG('m12i', 0, 0)
+    assert_close(
+        errors.calc_errors(data, extrapolate=extrapolate, rng=chunk_rng, engine='numba'),
+        errors.calc_errors(data, extrapolate=extrapolate, rng=chunk_rng))
+
+@pytest.mark.parametrize('extrapolate', [False, True])
+def test_rvs_select(data, extrapolate):
+    np.testing.assert_array_equal(
+        selection.calc_rvs_select(data, extrapolate=extrapolate, engine='numba'),
+        selection.calc_rvs_select(data, extrapolate=extrapolate))
@@ -0,0 +1,53 @@
+import shutil
+from types import SimpleNamespace
+
+import h5py
+import numpy as np
+
+from ananke import lineage
+
+def make_tree(basedir):
+    """ Write an external input file and a stage output """
+    basedir.mkdir(parents=True, exist_ok=True)
+    ext_path = basedir / 'ext.bin'
+    ext_path.write_bytes(b'header' + bytes(100))
+    out_path = basedir / 'out.hdf5'
+    with h5py.File(out_path, 'w') as f:
+        f.create_dataset('a', data=np.arange(5.))
+    return ext_path, out_path
+
+def get_record(basedir, version=1, seed=0):
+    inputs = [(str(basedir / 'ext.bin'), None)]
+    return lineage.make_record(
+        'stage', version, SimpleNamespace(seed=seed), ('seed', ), inputs,
+        basedirs=(str(basedir), ))
+
+def test_skip_and_invalidate(tmp_path):
+    ext_path, out_path = make_tree(tmp_path)
+    assert not lineage.is_up_to_date(out_path, 'stage', get_record(tmp_path))
+
+    lineage.write_record(out_path, 'stage', get_record(tmp_path), ['a'])
+    assert lineage.is_up_to_date(out_path, 'stage', get_record(tmp_path))
+    assert not lineage.is_up_to_date(out_path, 'stage', get_record(tmp_path, version=2))
+    assert not lineage.is_up_to_date(out_path, 'stage', get_record(tmp_path, seed=1))
+
+    ext_path.write_bytes(b'header' + bytes(101))
+    assert not lineage.is_up_to_date(out_path, 'stage', get_record(tmp_path))
+
+def test_upstream_fingerprint(tmp_path):
+    _, out_path = make_tree(tmp_path)
+    lineage.write_record(out_path, 'stage', get_record(tmp_path), ['a'])
+    before = lineage.fingerprint(out_path, 'stage')
+    assert lineage.fingerprint(out_path, 'stage') == before
+
+    # rerunning the upstream stage changes the fingerprint of its output
+    lineage.write_record(out_path, 'stage', get_record(tmp_path), ['a'])
+    assert lineage.fingerprint(out_path, 'stage') != before
+
+def test_copied_tree_is_up_to_date(tmp_path):
+    _, out_path = make_tree(tmp_path / 'run')
+    lineage.write_record(out_path, 'stage', get_record(tmp_path / 'run'), ['a'])
+
+    shutil.copytree(tmp_path / 'run', tmp_path / 'copy', copy_function=shutil.copy)
+    assert lineage.is_up_to_date(
+        tmp_path / 'copy' / 'out.hdf5', 'stage', get_record(tmp_path / 'copy'))
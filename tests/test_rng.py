@@ -0,0 +1,46 @@
+import numpy as np
+
+from ananke import rng
+from ananke.benchmarks import synthetic
+from ananke.bin import calc_props
+from ananke.rng import ChunkRNG
+
+def test_offset_invariance():
+    chunk_rng = ChunkRNG('m12i', 0, 0, seed=1)
+    full = chunk_rng.standard_normal('ra', 1000)
+    parts = [chunk_rng.at(start).standard_normal('ra', stop - start)
+             for start, stop in ((0, 300), (300, 301), (301, 1000))]
+    np.testing.assert_array_equal(np.concatenate(parts), full)
+
+def test_block_size_invariance(monkeypatch):
+    chunk_rng = ChunkRNG('m12i', 0, 0).at(17)
+    full = chunk_rng.standard_normal('ra', 1000)
+    monkeypatch.setattr(rng, '_BLOCK_SIZE', 7)
+    np.testing.assert_array_equal(chunk_rng.standard_normal('ra', 1000), full)
+
+def test_independent_streams():
+    chunk_rng = ChunkRNG('m12i', 0, 0)
+    draws = [
+        chunk_rng.standard_normal('ra', 100),
+        chunk_rng.standard_normal('dec', 100),
+        ChunkRNG('m12i', 0, 1).standard_normal('ra', 100),
+        ChunkRNG('m12i', 0, 0, seed=1).standard_normal('ra', 100),
+    ]
+    for i in range(len(draws)):
+        for j in range(i):
+            assert not np.allclose(draws[i], draws[j])
+
+def test_batch_size_invariance():
+    data = synthetic.make_batch(2000, np.random.default_rng(0))
+    chunk_rng = ChunkRNG('m12i', 0, 0)
+
+    def calc(start, stop):
+        batch = {key: val[start: stop] for key, val in data.items()}
+        return calc_props._calc_batch_worker(
+            batch, 'bminr', False, False, chunk_rng.at(start))
+
+    full = calc(0, 2000)
+    batches = [calc(start, min(start + 700, 2000)) for start in range(0, 2000, 700)]
+    for key, val in full.items():
+        np.testing.assert_array_equal(
+            np.concatenate([batch[key] for batch in batches]), val, err_msg=key)
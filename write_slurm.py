@@ -17,6 +17,8 @@ def parse_cmd():
                         help='accounting group')
     parser.add_argument('-t', '--time', type=str, default='00:30:00',
                         help='wall time of job')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of worker processes per job')
     return parser.parse_args()
 
 FLAGS = parse_cmd()
@@ -27,6 +29,7 @@ Njob = FLAGS.Njob
 partition = FLAGS.partition
 t = FLAGS.time
 account = FLAGS.accounting_group
+workers = FLAGS.workers
 
 print(f'Galaxy, LSR, rslice: {gal}, {lsr}, {rslice}')
 
@@ -37,7 +40,7 @@ os.makedirs(submit_dir, exist_ok=True)
 # Submit command
 run_cmd = "srun -n1 -N1 ananke-make-catalog "\
     f"--gal {gal} --lsr {lsr} --rslice {rslice} "\
-    "--err-extrapolate --ijob {} --Njob {}"
+    f"--err-extrapolate --workers {workers} --ijob {{}} --Njob {{}}"
 
 all_batch_fn = []
 for ijob in range(Njob):